@@ -0,0 +1,66 @@
+#!/bin/python
+'''
+Import time budget of hotterdeploy.
+
+Imports hotterdeploy.app in fresh interpreters, reports the median time
+and fails when it is over budget or when a module that should only load
+on first use was imported.
+
+usage: python benchmarks/import_time.py [--budget SECONDS] [--runs N]
+'''
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only needed once a stylesheet is compiled, a war deployed or /info shown
+LAZY_MODULES = ['pkg_resources', 'scss', 'sass', 'jinja2', 'pyjavaproperties']
+
+PROBE = '''
+import sys, time, json
+start = time.time()
+import hotterdeploy.app
+print(json.dumps({
+    'seconds': time.time() - start,
+    'modules': [name for name in %r if name in sys.modules],
+}))
+''' % LAZY_MODULES
+
+
+def measure(runs):
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=ROOT)
+        results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time budget')
+    parser.add_argument('--budget', default=0.5, type=float, help='seconds the import may take')
+    parser.add_argument('--runs', default=5, type=int, help='number of fresh interpreters to measure')
+    args = parser.parse_args()
+
+    results = measure(args.runs)
+    timings = sorted(result['seconds'] for result in results)
+    median = timings[len(timings) // 2]
+    loaded = sorted(set(name for result in results for name in result['modules']))
+
+    print('import hotterdeploy.app: median {0:.3f}s, best {1:.3f}s, worst {2:.3f}s (budget {3:.3f}s)'.format(
+        median, timings[0], timings[-1], args.budget))
+    failed = False
+    if median > args.budget:
+        print('FAIL: over budget')
+        failed = True
+    if loaded:
+        print('FAIL: imported on startup: {0}'.format(', '.join(loaded)))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+A scripted stand-in for Liferay, enough to deploy wars against.
+
+Wars dropped in the deploy directory next to tomcat are picked up after
+a startup delay: their jars are extracted into a new temp/NN-name
+directory, webapps/name is created, the war is removed and the line
+Liferay logs once the portlet is available is appended to catalina.out.
+Removing webapps/name logs the portlet being unregistered.
+'''
+
+import os
+import time
+import zipfile
+from threading import Thread, Event
+
+AVAILABLE = 'INFO  [localhost-startStop-1][PortletHotDeployListener:343] 1 portlet for {0} is available for use\n'
+UNREGISTERED = 'INFO  [localhost-startStop-1][PortletHotDeployListener:467] 1 portlet for {0} was unregistered\n'
+
+
+class ScriptedLiferay(Thread):
+    def __init__(self, tomcat_directory, startup_delay=0.5, interval=0.05):
+        super(ScriptedLiferay, self).__init__(name='ScriptedLiferay')
+        self.daemon = True
+        self.tomcat_directory = tomcat_directory
+        self.deploy_directory = os.path.abspath(os.path.join(tomcat_directory, '..', 'deploy'))
+        self.webapps_directory = os.path.join(tomcat_directory, 'webapps')
+        self.temp_directory = os.path.join(tomcat_directory, 'temp')
+        self.log_path = os.path.join(tomcat_directory, 'logs', 'catalina.out')
+        self.startup_delay = startup_delay
+        self.interval = interval
+        self.deployed = set(os.listdir(self.webapps_directory))
+        self._counter = 1000
+        self._stopped = Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def log(self, line):
+        with open(self.log_path, 'a') as f:
+            f.write(time.strftime('%H:%M:%S,000 ') + line)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            for name in list(self.deployed):
+                if not os.path.isdir(os.path.join(self.webapps_directory, name)):
+                    self.deployed.discard(name)
+                    self.log(UNREGISTERED.format(name))
+
+            for war in sorted(os.listdir(self.deploy_directory)):
+                if war.endswith('.war'):
+                    self.deploy(os.path.join(self.deploy_directory, war))
+
+    def deploy(self, war_path):
+        name = os.path.basename(war_path)[:-len('.war')]
+        time.sleep(self.startup_delay)
+
+        self._counter += 1
+        temp = os.path.join(self.temp_directory, '{0}-{1}'.format(self._counter, name))
+        with zipfile.ZipFile(war_path, 'r') as war:
+            war.extractall(temp)
+        os.remove(war_path)
+
+        webinf = os.path.join(self.webapps_directory, name, 'WEB-INF')
+        if not os.path.isdir(webinf):
+            os.makedirs(webinf)
+        with open(os.path.join(webinf, 'web.xml'), 'w') as f:
+            f.write('<web-app/>')
+        self.deployed.add(name)
+        self.log(AVAILABLE.format(name))
@@ -0,0 +1,364 @@
+#!/bin/python
+'''
+Benchmarks hotterdeploy against a synthetic workspace and tomcat.
+
+Scenarios:
+  startup_scan   scanning the workspace and constructing HotterDeployer,
+                 without and with the startup cache
+  event_to_copy  bursts of saves in the workspace until every file landed
+                 in tomcat, and until the browser reload
+  jar_diff       comparing the jars of a war with the deployed ones,
+                 with cold and warm crc caches
+  deploy_e2e     dropping a war in the hotterdeploy directory until the
+                 browser reload, against a scripted Liferay, for wars with
+                 the same jars, a changed jar, and only a changed jsp after
+                 a first deploy (patched in place with --delta_deploy)
+
+Everything runs offline in a temporary directory. The results are saved as
+JSON, by default in benchmarks/results/<commit>.json (ignored by git), to
+compare commits.
+
+usage: python benchmarks/run.py [SCENARIO ...] [--modules N] [--output PATH]
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from threading import Condition
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from synthetic import generate, module_names, jar_names, make_war
+from liferay import ScriptedLiferay
+
+from hotterdeploy import deploy
+from hotterdeploy.app import HotterDeployer
+from hotterdeploy.metrics import METRICS
+from hotterdeploy.polling import PollingRules, DEFAULT_EXCLUDES
+from hotterdeploy.utilities import scan_working_directory_for_portlet_contexts
+
+SCENARIOS = ['startup_scan', 'event_to_copy', 'jar_diff', 'deploy_e2e']
+
+
+def summary(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'min': samples[0],
+        'p50': samples[len(samples) // 2],
+        'p95': samples[min(int(0.95 * len(samples)), len(samples) - 1)],
+        'max': samples[-1],
+        'mean': sum(samples) / len(samples),
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode('utf-8').strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+    return commit, bool(dirty.strip())
+
+
+class ReloadRecorder(object):
+    '''
+    Stands in for the livereload server, remembering when reloads were sent
+    '''
+    def __init__(self):
+        self.reloads = []
+        self._condition = Condition()
+
+    def __call__(self, path=None, portlet_name=None):
+        with self._condition:
+            self.reloads.append((time.time(), path, portlet_name))
+            self._condition.notify_all()
+
+    def wait_for(self, portlet_name, since, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                for at, _, name in self.reloads:
+                    if name == portlet_name and at >= since:
+                        return at
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+
+class Bench(object):
+    def __init__(self, args, directory):
+        self.args = args
+        self.directory = directory
+        self.workspace, self.tomcat = generate(
+            directory, args.modules, args.hooks, args.files, args.classes, args.jars, args.jar_size)
+        self.names = module_names(args.modules, args.hooks)
+        self.portlets = [name for name in self.names if name.endswith('-portlet')]
+
+    def deployer(self, cache_directory=None, **kwargs):
+        return HotterDeployer(
+            self.workspace, self.tomcat, '', 'ROOT',
+            self.args.poll, None,
+            self.args.quiet_window,
+            cache_directory,
+            PollingRules([], DEFAULT_EXCLUDES),
+            self.args.poll_interval,
+            self.args.poll_interval,
+            **kwargs)
+
+    def module_root(self, name):
+        index = self.names.index(name)
+        return os.path.join(self.workspace, 'group{0}'.format(index % 4), name)
+
+    def startup_scan(self):
+        scans = []
+        for _ in range(self.args.rounds):
+            start = time.time()
+            portlets = scan_working_directory_for_portlet_contexts(self.workspace)
+            scans.append(time.time() - start)
+        assert len(portlets) == len(self.names)
+
+        cache_directory = os.path.join(self.directory, 'cache')
+        results = {'scan_working_directory': summary(scans)}
+        for label, cache in (('construct_cold', None), ('construct_warm', cache_directory)):
+            if cache:
+                # Fill the cache
+                self.deployer(cache).sass_compiler.stop()
+            timings = []
+            for _ in range(self.args.rounds):
+                start = time.time()
+                deployer = self.deployer(cache)
+                timings.append(time.time() - start)
+                deployer.sass_compiler.stop()
+                del deployer
+            results[label] = summary(timings)
+        return results
+
+    def event_to_copy(self):
+        deployer = self.deployer()
+        recorder = ReloadRecorder()
+        deployer.trigger_browser_reload = recorder
+        deployer.coalescer.start()
+        deployer.observer.start()
+        # Let the observer settle on its watches
+        time.sleep(0.5 if not self.args.poll else self.args.poll_interval * 2)
+
+        extensions = ('jsp', 'js', 'jspf')
+        copies = []
+        reloads = []
+        missed = 0
+        try:
+            for r in range(self.args.rounds):
+                writes = []
+                for n in range(self.args.burst):
+                    name = self.portlets[n % len(self.portlets)]
+                    j = (n // len(self.portlets)) % self.args.files
+                    rel_path = os.path.join('html', 'section{0}'.format(j % 5), 'file{0}.{1}'.format(j, extensions[j % 3]))
+                    content = '/* round {0} save {1} */\n'.format(r, n) * 20
+                    src = os.path.join(self.module_root(name), 'src', 'main', 'webapp', rel_path)
+                    dest = os.path.join(deployer.find_latest_temp_dir(name), rel_path)
+                    with open(src, 'w') as f:
+                        f.write(content)
+                    writes.append((time.time(), name, dest, content))
+
+                pending = list(writes)
+                deadline = time.time() + self.args.timeout
+                while pending and time.time() < deadline:
+                    still_pending = []
+                    for write in pending:
+                        try:
+                            with open(write[2]) as f:
+                                landed = f.read() == write[3]
+                        except IOError:
+                            landed = False
+                        if landed:
+                            copies.append(time.time() - write[0])
+                        else:
+                            still_pending.append(write)
+                    pending = still_pending
+                    time.sleep(0.001)
+                missed += len(pending)
+
+                first_write = {}
+                for at, name, _, _ in writes:
+                    first_write.setdefault(name, at)
+                for name, at in first_write.items():
+                    reloaded = recorder.wait_for(name, at, self.args.timeout)
+                    if reloaded is None:
+                        missed += 1
+                    else:
+                        reloads.append(reloaded - at)
+                # Let the batches of this round go before the next one
+                time.sleep(self.args.quiet_window * 2)
+        finally:
+            deployer.observer.stop()
+            deployer.coalescer.stop()
+            deployer.sass_compiler.stop()
+            deployer.observer.join()
+
+        return {
+            'save_to_copy': summary(copies),
+            'save_to_reload': summary(reloads),
+            'missed': missed,
+            'metrics': METRICS.snapshot(),
+        }
+
+    def jar_diff(self):
+        temp = os.path.join(self.tomcat, 'temp', '10-' + self.portlets[0])
+        staging = os.path.join(self.directory, 'staging')
+        same = make_war(os.path.join(staging, 'same', self.portlets[0] + '.war'),
+                        self.portlets[0], self.args.jars, self.args.jar_size)
+        changed = make_war(os.path.join(staging, 'changed', self.portlets[0] + '.war'),
+                           self.portlets[0], self.args.jars, self.args.jar_size, jar_names(self.args.jars)[-1:])
+        megabytes = self.args.jars * self.args.jar_size / (1024.0 * 1024.0)
+
+        results = {'megabytes': megabytes}
+        for label, war, clear in (('cold', same, True), ('warm', same, False), ('changed', changed, True)):
+            timings = []
+            for _ in range(self.args.rounds):
+                if clear:
+                    deploy._crc_cache.clear()
+                start = time.time()
+                needs_undeploy = deploy.check_for_lib_diffs(war, temp)
+                timings.append(time.time() - start)
+                assert needs_undeploy == (war is changed)
+            results[label] = summary(timings)
+            results[label]['megabytes_per_second'] = megabytes / max(results[label]['p50'], 1e-9)
+        return results
+
+    def deploy_e2e(self):
+        deployer = self.deployer(delta_deploy=self.args.delta_deploy)
+        recorder = ReloadRecorder()
+        deployer.trigger_browser_reload = recorder
+        liferay = ScriptedLiferay(self.tomcat, self.args.startup_delay)
+        liferay.start()
+        deployer.coalescer.start()
+        deployer.deploy_queue.start()
+        deployer.observer.start()
+        time.sleep(0.5)
+
+        staging = os.path.join(self.directory, 'staging', 'deploy')
+        rounds = min(self.args.deploy_rounds, len(self.portlets) // 3)
+        results = {}
+
+        def drop(name, changed_jars=(), resources=None):
+            war = make_war(os.path.join(staging, name + '.war'), name,
+                           self.args.jars, self.args.jar_size, changed_jars, resources)
+            start = time.time()
+            shutil.move(war, os.path.join(deployer.hotterdeploy_dir, name + '.war'))
+            reloaded = recorder.wait_for(name, start, self.args.timeout)
+            return None if reloaded is None else reloaded - start
+
+        try:
+            # Every case deploys to portlets of its own, so each war is
+            # compared against the jars the synthetic tomcat started with
+            for label, offset, changed_jars in (('same_jars', 0, ()),
+                                                ('changed_jars', rounds, jar_names(self.args.jars)[-1:]),
+                                                ('resources_only', 2 * rounds, ())):
+                timings = []
+                failed = 0
+                for r in range(rounds):
+                    name = self.portlets[offset + r]
+                    if label == 'resources_only':
+                        # The first deploy tells hotterdeploy the descriptors
+                        drop(name, resources={'view.jsp': '<p>first</p>'})
+                        timing = drop(name, resources={'view.jsp': '<p>second</p>'})
+                    else:
+                        timing = drop(name, changed_jars)
+                    if timing is None:
+                        failed += 1
+                    else:
+                        timings.append(timing)
+                results[label] = summary(timings)
+                results[label]['failed'] = failed
+        finally:
+            deployer.observer.stop()
+            deployer.deploy_queue.stop()
+            deployer.coalescer.stop()
+            deployer.sass_compiler.stop()
+            liferay.stop()
+            deployer.observer.join()
+        results['startup_delay'] = self.args.startup_delay
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hotter deploy benchmarks')
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help='scenarios to run: {0} (default all)'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--modules', default=20, type=int, help='portlet modules in the workspace')
+    parser.add_argument('--hooks', default=2, type=int, help='hook modules in the workspace')
+    parser.add_argument('--files', default=50, type=int, help='webapp files per module')
+    parser.add_argument('--classes', default=100, type=int, help='class files per module')
+    parser.add_argument('--jars', default=20, type=int, help='jars per war')
+    parser.add_argument('--jar_size', default=64 * 1024, type=int, help='bytes per jar')
+    parser.add_argument('--rounds', default=5, type=int, help='repetitions of every measurement')
+    parser.add_argument('--burst', default=20, type=int, help='files saved at once in event_to_copy')
+    parser.add_argument('--deploy_rounds', default=2, type=int, help='wars deployed per case in deploy_e2e')
+    parser.add_argument('--startup_delay', default=0.5, type=float, help='seconds the scripted Liferay takes to deploy a war')
+    parser.add_argument('--delta_deploy', action='store_true', help='patch wars into the deployed directory when possible in deploy_e2e')
+    parser.add_argument('--quiet_window', default=0.2, type=float, help='quiet window of the event coalescer')
+    parser.add_argument('--poll', action='store_true', help='use the polling observer instead of FS events')
+    parser.add_argument('--poll_interval', default=0.1, type=float, help='seconds between polls with --poll')
+    parser.add_argument('--timeout', default=30, type=float, help='seconds to wait for a copy, reload or deploy')
+    parser.add_argument('--directory', default=None, help='where to generate the workspace and tomcat, a temporary directory by default')
+    parser.add_argument('--output', default=None, help='where to write the JSON results, benchmarks/results/<commit>.json by default')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the hotterdeploy log')
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('unknown scenario {0}, choose from {1}'.format(scenario, ', '.join(SCENARIOS)))
+    args.scenarios = args.scenarios or SCENARIOS
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR,
+                        format='%(levelname)7s:%(name)s: %(message)s')
+
+    commit, dirty = git_commit()
+    directory = args.directory or tempfile.mkdtemp(prefix='hotterdeploy-bench-')
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': dict((key, value) for key, value in vars(args).items() if key not in ('output', 'verbose')),
+        'results': {},
+    }
+    try:
+        bench = Bench(args, directory)
+        for scenario in args.scenarios:
+            print('Running {0}...'.format(scenario))
+            start = time.time()
+            results['results'][scenario] = getattr(bench, scenario)()
+            print('  took {0:.1f}s'.format(time.time() - start))
+    finally:
+        if not args.directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    for scenario, result in sorted(results['results'].items()):
+        for case, values in sorted(result.items()):
+            if isinstance(values, dict) and 'p50' in values:
+                print('{0:14} {1:24} p50 {2:8.1f}ms  p95 {3:8.1f}ms  max {4:8.1f}ms  (n={5})'.format(
+                    scenario, case, values['p50'] * 1000, values['p95'] * 1000, values['max'] * 1000, values['count']))
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', '{0}.json'.format(commit[:12]))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results written to {0}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
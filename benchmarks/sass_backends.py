@@ -0,0 +1,70 @@
+#!/bin/python
+'''
+Compares the installed stylesheet compilers.
+
+Compiles generated theme stylesheets (or the given ones) with every
+installed backend of hotterdeploy.sassc and reports the first, best and
+mean compile time. The first compile counts, pyScss caches repeated
+compiles of the same file.
+
+usage: python benchmarks/sass_backends.py [STYLESHEET ...] [--rounds N] [--partials N]
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from synthetic import generate_theme
+
+from hotterdeploy.sassc import BACKENDS, SassException
+
+
+def benchmark(files, rounds):
+    for name, backend_class in BACKENDS.items():
+        try:
+            backend = backend_class()
+        except ImportError:
+            print('{0:8} not installed'.format(name))
+            continue
+        for file_name in files:
+            timings = []
+            for _ in range(rounds):
+                start = time.time()
+                try:
+                    backend.compile(file_name)
+                except SassException as e:
+                    print('{0:8} {1}: {2}'.format(name, file_name, e))
+                    break
+                timings.append(time.time() - start)
+            if timings:
+                print('{0:8} {1}: first {2:.3f}s, best {3:.3f}s, mean {4:.3f}s'.format(
+                    name, os.path.basename(file_name), timings[0], min(timings), sum(timings) / len(timings)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stylesheet compiler benchmark')
+    parser.add_argument('files', nargs='*', metavar='STYLESHEET', help='stylesheets to compile, a generated theme by default')
+    parser.add_argument('--rounds', default=5, type=int, help='compiles per stylesheet and backend')
+    parser.add_argument('--partials', default=20, type=int, help='portlet partials imported by the generated theme')
+    args = parser.parse_args()
+
+    directory = None
+    files = args.files
+    if not files:
+        directory = tempfile.mkdtemp(prefix='hotterdeploy-sass-')
+        files = [generate_theme(directory, args.partials)]
+    try:
+        benchmark(files, args.rounds)
+    finally:
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
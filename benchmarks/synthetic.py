@@ -0,0 +1,202 @@
+'''
+Generates a synthetic Liferay workspace and the tomcat it is deployed to.
+
+The workspace has portlet modules (pom.xml, a src/main/webapp tree with
+jsps, js and stylesheets, target/classes) and hook modules overriding
+portal jsps. The tomcat has a temp/NN-name and webapps/name directory per
+module with the jars of its war, a ROOT webapp with the hooked jsps and
+an empty logs/catalina.out. Theme stylesheets are generated on their own.
+'''
+
+import os
+import random
+import shutil
+import zipfile
+import binascii
+
+POM = '''<?xml version="1.0"?>
+<project>
+  <groupId>com.example</groupId>
+  <artifactId>{name}</artifactId>
+  <version>1.0.0</version>
+  <packaging>war</packaging>
+</project>
+'''
+
+HOOK_XML = '''<?xml version="1.0"?>
+<hook>
+  <custom-jsp-dir>/custom_jsps</custom-jsp-dir>
+</hook>
+'''
+
+PLUGIN_PACKAGE = '''name={name}
+portal-dependency-jars=jstl-api.jar,jstl-impl.jar
+'''
+
+
+def _write(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def module_names(modules, hooks):
+    return (['bench{0:03d}-portlet'.format(i) for i in range(modules)] +
+            ['bench{0:03d}-hook'.format(i) for i in range(hooks)])
+
+
+def jar_names(jars):
+    return ['lib{0:03d}.jar'.format(i) for i in range(jars)]
+
+
+def jar_data(name, size, version=0):
+    '''
+    Deterministic content, so the war and the deployed jars match
+    '''
+    rnd = random.Random('{0}-{1}'.format(name, version))
+    return binascii.unhexlify('%0*x' % (size * 2, rnd.getrandbits(size * 8)))
+
+
+def generate_workspace(directory, modules=20, hooks=2, files=50, classes=100, groups=4):
+    '''
+    Returns module root -> portlet name
+    '''
+    roots = {}
+    for i, name in enumerate(module_names(modules, hooks)):
+        root = os.path.join(directory, 'group{0}'.format(i % groups), name)
+        roots[root] = name
+        _write(os.path.join(root, 'pom.xml'), POM.format(name=name))
+        webapp = os.path.join(root, 'src', 'main', 'webapp')
+        _write(os.path.join(webapp, 'WEB-INF', 'web.xml'), '<web-app/>')
+
+        if name.endswith('-hook'):
+            _write(os.path.join(webapp, 'WEB-INF', 'liferay-hook.xml'), HOOK_XML)
+            for j in range(files):
+                _write(os.path.join(webapp, 'custom_jsps', 'html', 'portlet', 'view{0}.jsp'.format(j)),
+                       '<p>hook {0} {1}</p>'.format(name, j))
+            continue
+
+        _write(os.path.join(webapp, 'WEB-INF', 'portlet.xml'),
+               '<portlet-app><portlet><portlet-name>{0}</portlet-name></portlet></portlet-app>'.format(name))
+        _write(os.path.join(webapp, 'css', '_variables.scss'), '$color: #336699;\n')
+        _write(os.path.join(webapp, 'css', 'main.css'),
+               '@import "variables";\n.{0} {{ color: $color; }}\n'.format(name.replace('-', '_')))
+        for j in range(files):
+            extension = ('jsp', 'js', 'jspf')[j % 3]
+            _write(os.path.join(webapp, 'html', 'section{0}'.format(j % 5), 'file{0}.{1}'.format(j, extension)),
+                   '/* {0} {1} */\n'.format(name, j) * 20)
+        for j in range(classes):
+            _write(os.path.join(root, 'target', 'classes', 'com', 'example', 'pkg{0}'.format(j % 10),
+                                'Class{0}.class'.format(j)),
+                   jar_data('Class{0}'.format(j), 512))
+    return roots
+
+
+def generate_tomcat(directory, names, jars=20, jar_size=64 * 1024, hooked_files=50):
+    '''
+    Returns portlet name -> its temp deploy directory
+    '''
+    deploys = {}
+    for i, name in enumerate(names):
+        temp = os.path.join(directory, 'temp', '{0}-{1}'.format(10 + i, name))
+        deploys[name] = temp
+        for jar in jar_names(jars):
+            _write(os.path.join(temp, 'WEB-INF', 'lib', jar), jar_data(jar, jar_size))
+        _write(os.path.join(directory, 'webapps', name, 'WEB-INF', 'web.xml'), '<web-app/>')
+
+    for j in range(hooked_files):
+        _write(os.path.join(directory, 'webapps', 'ROOT', 'html', 'portlet', 'view{0}.jsp'.format(j)),
+               '<p>portal {0}</p>'.format(j))
+    _write(os.path.join(directory, 'logs', 'catalina.out'), '')
+    return deploys
+
+
+def make_war(path, name, jars=20, jar_size=64 * 1024, changed_jars=(), resources=None):
+    '''
+    A war with the same jars as generate_tomcat deployed, except for
+    changed_jars, and the given entry name -> data
+    '''
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as war:
+        war.writestr('WEB-INF/portlet.xml',
+                     '<portlet-app><portlet><portlet-name>{0}</portlet-name></portlet></portlet-app>'.format(name))
+        war.writestr('WEB-INF/liferay-plugin-package.properties', PLUGIN_PACKAGE.format(name=name))
+        for jar in jar_names(jars):
+            version = 1 if jar in changed_jars else 0
+            war.writestr('WEB-INF/lib/' + jar, jar_data(jar, jar_size, version))
+        for entry, data in sorted((resources or {}).items()):
+            war.writestr(entry, data)
+    return path
+
+
+THEME_VARIABLES = '''$brand: #0b5fa5;
+$accent: #e8a33d;
+$gutter: 12px;
+$breakpoints: small 480px, medium 768px, large 1024px;
+'''
+
+THEME_MIXINS = '''@mixin respond-to($width) {
+  @media (min-width: $width) { @content; }
+}
+@mixin button-variant($color) {
+  background: $color;
+  border: 1px solid darken($color, 10%);
+  &:hover { background: lighten($color, 10%); }
+}
+'''
+
+THEME_PARTIAL = '''.portlet-{0} {{
+  padding: $gutter;
+  .title {{ color: darken($brand, {1}%); }}
+  .btn {{ @include button-variant(mix($brand, $accent, {2}%)); }}
+  @each $name, $width in (small: 480px, medium: 768px) {{
+    &.#{{$name}} {{ @include respond-to($width) {{ margin: $gutter * 2; }} }}
+  }}
+  @for $i from 1 through 4 {{
+    .col-#{{$i}} {{ width: percentage($i / 4); }}
+  }}
+}}
+'''
+
+
+def generate_theme(directory, partials=20):
+    '''
+    Stylesheets the way Liferay themes have them: scss in main.css,
+    importing variables, mixins and a partial per portlet.
+    Returns the path of main.css
+    '''
+    css = os.path.join(directory, 'css')
+    _write(os.path.join(css, '_variables.scss'), THEME_VARIABLES)
+    _write(os.path.join(css, '_mixins.scss'), THEME_MIXINS)
+    imports = ['@import "variables";', '@import "mixins";']
+    for i in range(partials):
+        _write(os.path.join(css, '_portlet{0}.scss'.format(i)),
+               THEME_PARTIAL.format(i, 5 + i % 20, 10 + i % 80))
+        imports.append('@import "portlet{0}";'.format(i))
+    main = os.path.join(css, 'main.css')
+    _write(main, '\n'.join(imports) + '\n')
+    return main
+
+
+def generate(directory, modules=20, hooks=2, files=50, classes=100, jars=20, jar_size=64 * 1024):
+    '''
+    A fresh workspace and tomcat under directory, returns their paths
+    '''
+    shutil.rmtree(directory, ignore_errors=True)
+    workspace = os.path.join(directory, 'workspace')
+    tomcat = os.path.join(directory, 'tomcat')
+    generate_workspace(workspace, modules, hooks, files, classes)
+    generate_tomcat(tomcat, module_names(modules, hooks), jars, jar_size, files)
+    os.makedirs(os.path.join(directory, 'deploy'))
+    return workspace, tomcat
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 2:
+        print('usage: python benchmarks/synthetic.py DIRECTORY')
+        sys.exit(1)
+    print('Generated {0} and {1}'.format(*generate(sys.argv[1])))
@@ -19,52 +19,45 @@ automatically undeploy and redeploy the affected portlet.
 
 import argparse
 import os
+import time
 import weakref
 import logging
 from logging.handlers import BufferingHandler
 
 from watchdog.observers import Observer
-from watchdog.observers.polling import PollingObserverVFS
-from watchdog.utils import stat as default_stat
+from watchdog.utils import UnsupportedLibc
 
 from livereload import Server
 
 from .utilities import (
-    scan_working_directory_for_portlet_contexts,
     scan_tomcat_temporary_directory,
     scan_tomcat_webapps_directory,
 )
+from .coalescer import EventCoalescer, ReloadScheduler
+from .workspace import WorkspaceIndex
+from .cache import StartupCache, default_cache_path, list_subdirectories
+from .deploy import DeployQueue
+from . import sassc
+from .sassc import SassCache, CompilerPool
+from .resync import Resync
+from .sync import FileSync, LINK_MODES, COPY
+from .polling import SnapshotPollingObserver, PollingRules, DEFAULT_EXCLUDES
+try:
+    from .watches import ScopedInotifyObserver
+except (ImportError, UnsupportedLibc):
+    # No inotify on this platform
+    ScopedInotifyObserver = None
 from .app_handlers import (
     OnTempDeployHandler,
     OnWebappsDeployHandler,
-    WorkSpaceHandler,
-    OnFileChangedHandler,
-    OnClassChangedHandler,
     OnDeployHandler,
+    EventRouter,
 )
 
 
 LOG = logging.getLogger(__name__)
 
 
-def listdir(directory):
-    paths = os.listdir(directory)
-    ret = []
-    patterns = '.java,.zip,.pptx'.split(',')
-    dir_Names = ['test', '.svn', '.settings', '.metadata']
-    for path in paths:
-        if all(map(lambda x: path != x, dir_Names)):
-            if path.find('.') == -1:
-                ret.append(path)
-            else:
-                if not any(map(lambda x: path.endswith(x), patterns)):
-                    ret.append(path)
-                else:
-                    pass
-                    # LOG.debug('Ignoring {0}'.format(path))
-    return ret
-
-
 class HotterDeployer(object):
     def __init__(
             self,
@@ -73,16 +66,50 @@ class HotterDeployer(object):
             hotterdeploy_dir,
             liferay_context,
             do_polling,
-            statics_directory
+            statics_directory,
+            quiet_window=0.2,
+            cache_directory=None,
+            poll_rules=None,
+            poll_interval=1,
+            poll_max_interval=None,
+            poll_threads=0,
+            deploy_workers=2,
+            sass_processes=2,
+            link_mode=COPY,
+            verify_hash=False,
+            page_map=None,
+            delta_deploy=False
             ):
         self.do_polling = do_polling
-        self.workspace_directory = workspace_directory
+        self.workspace_directory = os.path.abspath(workspace_directory)
         self.tomcat_directory = tomcat_directory
         self.liferay_context = liferay_context
         self.statics_directory = statics_directory
-        self.portlets = {}
+        self.workspace_index = WorkspaceIndex(workspace_directory)
+        self.portlets = self.workspace_index.portlets
         self.themes = {}
         self.deploys = {}
+        self._listings = {}
+
+        # Batches hot-copies per portlet, so a rebuild results in a single reload
+        self.coalescer = EventCoalescer(weakref.proxy(self), quiet_window)
+        # Reloads that wait for Spring Loaded, run on the livereload IOLoop
+        self.reload_scheduler = ReloadScheduler(weakref.proxy(self))
+
+        # Writes into the deployed directories, skipping unchanged content
+        self.file_sync = FileSync(link_mode, verify_hash)
+
+        # Compiled stylesheets and their import graphs
+        self.sass_cache = SassCache()
+        # Compiles stylesheets in worker processes, forked before any of our
+        # threads exist
+        self.sass_compiler = CompilerPool(sass_processes)
+        self.sass_compiler.start()
+
+        # Deploys wars dropped in the hotterdeploy directory, patching the
+        # deployed directory when only classes and resources changed
+        self.deploy_queue = DeployQueue(weakref.proxy(self), tomcat_directory, deploy_workers)
+        self.delta_deploy = delta_deploy
 
         if hotterdeploy_dir == '':
             self.hotterdeploy_dir = os.path.abspath(os.path.join(tomcat_directory, '..', 'hotterdeploy'))
@@ -93,8 +120,18 @@ class HotterDeployer(object):
         self.tomcat_webapps_dir = os.path.join(tomcat_directory, 'webapps')
         self.liferay_dir = os.path.join(self.tomcat_webapps_dir, self.liferay_context)
 
+        if cache_directory:
+            cache_path = default_cache_path(cache_directory, workspace_directory, tomcat_directory)
+        else:
+            cache_path = None
+        self.startup_cache = StartupCache(cache_path).load()
+        self._listings = self.startup_cache.get('listings', {})
+        start_time = time.time()
+
         if do_polling:
-            self.observer = PollingObserverVFS(default_stat, listdir)
+            self.observer = SnapshotPollingObserver(poll_rules, poll_interval, poll_max_interval, poll_threads)
+        elif ScopedInotifyObserver is not None:
+            self.observer = ScopedInotifyObserver()
         else:
             self.observer = Observer()
 
@@ -104,41 +141,44 @@ class HotterDeployer(object):
         self.observer.schedule(OnDeployHandler(hotterDeployer=self), self.hotterdeploy_dir, recursive=False)
 
         # Scan tomcat temp directory for deployed portlets
-        self._scan_temp()
+        self._scan_temp(startup=True)
         self.observer.schedule(OnTempDeployHandler(hotterDeployer=self), self.tomcat_temp_dir, recursive=False)
 
         # Scan tomcat webapps directory for deployed portlets
-        self._scan_webapps()
+        self._scan_webapps(startup=True)
         self.observer.schedule(OnWebappsDeployHandler(hotterDeployer=self), self.tomcat_webapps_dir, recursive=False)
 
         # Scan the working directory for portlets
         LOG.debug('Scanning workspace for portlets...')
-        self._scan_wd(workspace_directory)
-        LOG.debug('Done.')
-
-        # path = os.path.join(self.workspace_directory, 'liferay-portal', 'credoc-newsletter-portlet')
-        path = self.workspace_directory
+        self.workspace_index.load(self.startup_cache.get('workspace'))
+        LOG.debug('Scanning took {0} seconds'.format(time.time() - start_time))
+        self.save_cache()
 
-        # IN_CREATE | IN_DELETE | IN_CLOSE_WRITE && src/main/webapp/WEB-INF
-        w = self.observer.schedule(WorkSpaceHandler(hotterDeployer=self), path, recursive=True)
-        # IN_CLOSE_WRITE && src/main/webapp
-        self.observer.add_handler_for_watch(OnFileChangedHandler(hotterDeployer=self), w)
-        # self.observer.schedule(OnFileChangedHandler(hotterDeployer=self), self.workspace_directory, recursive=True)
-        # IN_CLOSE_WRITE && target/classes
-        self.observer.add_handler_for_watch(OnClassChangedHandler(hotterDeployer=self), w)
-        # self.observer.schedule(OnClassChangedHandler(hotterDeployer=self), self.workspace_directory, recursive=True)
+        # Only the scanned tree and the module areas are watched, through a
+        # single watch. The router hands the events to the rule of their area.
+        self.event_router = EventRouter(hotterDeployer=self)
+        try:
+            if hasattr(self.observer, 'schedule_scope'):
+                self.observer.schedule_scope(self.event_router, self.workspace_directory, self.workspace_index)
+            else:
+                # Without inotify the whole workspace is watched
+                self.observer.schedule(self.event_router, self.workspace_directory, recursive=True)
+        except OSError:
+            LOG.warn('Could not watch {0}, changes will not be copied'.format(self.workspace_directory), exc_info=True)
 
-        self.livereload_server = Server()
+        self.livereload_server = Server(page_map=page_map)
 
     def start(self):
-        import time
         start_time = time.time()
         LOG.debug('Starting observer...')
+        self.coalescer.start()
+        self.deploy_queue.start()
         self.observer.start()
         LOG.debug('Starting observer took {0} seconds'.format(time.time() - start_time))
 
-        from livereload import LiveReloadInfoHandler
+        from livereload import LiveReloadInfoHandler, ResyncHandler
         LiveReloadInfoHandler.hotterDeployer = weakref.proxy(self)
+        ResyncHandler.hotterDeployer = weakref.proxy(self)
 
         LOG.info('Using {0}'.format('polling' if self.do_polling else 'FS events'))
         LOG.info('Serving livereload on http://{host}:{port}/info'.format(**vars(self.livereload_server)))
@@ -147,15 +187,36 @@ class HotterDeployer(object):
             self.livereload_server.serve()
         except KeyboardInterrupt:
             self.observer.stop()
+            self.coalescer.stop()
+            self.deploy_queue.stop()
+            self.sass_compiler.stop()
             self.livereload_server.stop()
         self.observer.join()
+        self.save_cache()
 
     def __del__(self):
         if os.path.exists(self.hotterdeploy_dir):
             os.rmdir(self.hotterdeploy_dir)
 
     def _scan_wd(self, directory):
-        self.portlets.update(scan_working_directory_for_portlet_contexts(directory))
+        self.workspace_index.scan(directory)
+
+    def save_cache(self):
+        self.startup_cache.set('workspace', self.workspace_index.dump_state())
+        self.startup_cache.set('listings', dict(self._listings))
+        self.startup_cache.save()
+
+    def deployed_descriptors(self, bundle_name):
+        '''
+        The descriptors of the war last deployed for a bundle, if known
+        '''
+        return self.startup_cache.get('descriptors', {}).get(bundle_name)
+
+    def remember_descriptors(self, bundle_name, descriptors):
+        descriptors_by_bundle = dict(self.startup_cache.get('descriptors', {}))
+        descriptors_by_bundle[bundle_name] = descriptors
+        self.startup_cache.set('descriptors', descriptors_by_bundle)
+        self.save_cache()
 
     def _update_deploys(self):
         deploys = {}
@@ -170,14 +231,22 @@ class HotterDeployer(object):
 
         self.deploys = deploys
 
-    def _scan_temp(self):
+    def _scan_temp(self, startup=False):
+        '''
+        Only the startup scan reuses the cached listing, the mtime of a
+        directory does not always change within an event
+        '''
         path = os.path.join(self.tomcat_directory, 'temp')
-        self._temp_deploys = scan_tomcat_temporary_directory(path)
+        cached = self._listings.get('temp') if startup else None
+        self._listings['temp'], subdirectories = list_subdirectories(path, cached)
+        self._temp_deploys = scan_tomcat_temporary_directory(path, subdirectories)
         self._update_deploys()
 
-    def _scan_webapps(self):
+    def _scan_webapps(self, startup=False):
         path = os.path.join(self.tomcat_directory, 'webapps')
-        self._webapp_deploys = scan_tomcat_webapps_directory(path)
+        cached = self._listings.get('webapps') if startup else None
+        self._listings['webapps'], subdirectories = list_subdirectories(path, cached)
+        self._webapp_deploys = scan_tomcat_webapps_directory(path, subdirectories)
         self._update_deploys()
 
     def find_latest_temp_dir(self, portlet_name):
@@ -188,9 +257,19 @@ class HotterDeployer(object):
         latest_subdir = self.deploys.get(portlet_name, None)
         return latest_subdir
 
-    def trigger_browser_reload(self, path=None):
+    def resync(self, portlet_names=None):
+        '''
+        Copy whatever differs between the given modules, or all of them, and
+        their deployed directories
+        '''
+        return Resync(self).run(portlet_names)
+
+    def trigger_browser_reload(self, path=None, portlet_name=None):
+        '''
+        Reload the pages showing a portlet, or all pages when none is given
+        '''
         LOG.debug('reloading browser')
-        self.livereload_server.reload(path)
+        self.livereload_server.reload(path, portlet_name)
 
 
 class MemoryBufferHandler(BufferingHandler):
@@ -214,6 +293,22 @@ def main():
     parser.add_argument('--liferay_context', default='ROOT', help='the liferay context path')
     parser.add_argument('--poll', action='store_true', help='poll instead of listen for FS events, needed on network shares and vboxfs')
     parser.add_argument('--statics_dir', default=None, help='where to place the static resources')
+    parser.add_argument('--poll_interval', default=1, type=float, help='seconds between polls right after a change')
+    parser.add_argument('--poll_max_interval', default=5, type=float, help='seconds between polls when nothing changes')
+    parser.add_argument('--poll_include', action='append', default=[], help='only poll files matching this glob, can be repeated')
+    parser.add_argument('--poll_exclude', action='append', default=[], help='do not poll files or directories matching this glob, can be repeated')
+    parser.add_argument('--poll_threads', default=0, type=int, help='stat independent subtrees in parallel with this many threads')
+    parser.add_argument('--deploy_workers', default=2, type=int, help='number of wars deployed at the same time')
+    parser.add_argument('--sass_backend', default='auto', choices=['auto'] + list(sassc.BACKENDS), help='stylesheet compiler, auto prefers libsass over pyScss')
+    parser.add_argument('--sass_processes', default=2, type=int, help='number of processes compiling stylesheets')
+    parser.add_argument('--link_mode', default=COPY, choices=LINK_MODES, help='hard link or reflink files into tomcat instead of copying them, when on the same file system')
+    parser.add_argument('--verify_hash', action='store_true', help='compare the content of files that were touched without changing size, to skip rewriting them')
+    parser.add_argument('--resync', nargs='*', metavar='PORTLET', help='on startup copy whatever differs between these portlets, or all when none given, and their deployed directories')
+    parser.add_argument('--page_map', action='append', default=[], metavar='URL_GLOB=PORTLET[,PORTLET]', help='only reload pages matching the glob for changes to these portlets, on top of what the pages report themselves, can be repeated')
+    parser.add_argument('--delta_deploy', action='store_true', help='when only classes and resources of a deployed war changed, write those into the deployed directory instead of deploying the war')
+    parser.add_argument('--cache_dir', default=os.path.join(os.path.expanduser('~'), '.hotterdeploy'), help='where to keep the startup cache')
+    parser.add_argument('--no_cache', action='store_true', help='always do a full scan on startup')
+    parser.add_argument('--quiet_window', default=0.2, type=float, help='seconds without changes before a batch of changes is copied')
 
     parser.add_argument(
         '-v',
@@ -235,6 +330,18 @@ def main():
 
     args = parser.parse_args()
 
+    try:
+        sassc.use_backend(args.sass_backend)
+    except ImportError as e:
+        parser.error(str(e))
+
+    page_map = []
+    for mapping in args.page_map:
+        url_pattern, _, portlet_names = mapping.rpartition('=')
+        if not url_pattern or not portlet_names:
+            parser.error('--page_map expects URL_GLOB=PORTLET[,PORTLET], got {0}'.format(mapping))
+        page_map.append((url_pattern, set(portlet_names.split(','))))
+
     memory_handler = MemoryBufferHandler()
 
     # Setup basic logging
@@ -251,9 +358,23 @@ def main():
                               args.hotterdeploy_dir,
                               args.liferay_context,
                               args.poll,
-                              args.statics_dir)
+                              args.statics_dir,
+                              args.quiet_window,
+                              None if args.no_cache else args.cache_dir,
+                              PollingRules(args.poll_include, DEFAULT_EXCLUDES + args.poll_exclude),
+                              args.poll_interval,
+                              args.poll_max_interval,
+                              args.poll_threads,
+                              args.deploy_workers,
+                              args.sass_processes,
+                              args.link_mode,
+                              args.verify_hash,
+                              page_map,
+                              args.delta_deploy)
 
     deployer.memory_handler = memory_handler
+    if args.resync is not None:
+        deployer.resync(args.resync)
     deployer.start()
     del deployer
 
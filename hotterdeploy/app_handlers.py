@@ -2,21 +2,33 @@ import os
 import weakref
 import shutil
 import logging
+from functools import partial
+from itertools import chain
 
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import (
+    FileSystemEventHandler,
+    EVENT_TYPE_CREATED,
+    EVENT_TYPE_DELETED,
+    EVENT_TYPE_MODIFIED,
+    EVENT_TYPE_MOVED,
+)
 
-from .utilities import is_jsp_hook
-from .deploy import Deploy
+from .utilities import is_jsp_hook, invalidate_hook_cache
+from .coalescer import RELOAD_ALL, RELOAD_STYLESHEETS, RELOAD_PORTAL, SPRING_LOADED_SETTLE_TIME
+from .workspace import WEBAPP_AREA, CLASSES_AREA
 
 from . import sassc
+from .metrics import METRICS
 
 LOG = logging.getLogger(__name__)
 
-def normalize_path(path):
-    return path.replace('/', os.sep)
+# Files under src/main/webapp that are hot-copied
+HOT_COPY_EXTENSIONS = ('.jsp', '.js', '.css', '.scss', '.tag', '.vm', '.jspf')
 
-def contains_path(path, sub_path):
-    return path.find(normalize_path(sub_path)) != -1
+ALL_EVENT_TYPES = (EVENT_TYPE_CREATED, EVENT_TYPE_DELETED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED)
+
+def in_area(location, area):
+    return location is not None and location.area == area
 
 
 class OnDeployHandler(FileSystemEventHandler):
@@ -25,11 +37,18 @@ class OnDeployHandler(FileSystemEventHandler):
         self.hotterDeployer = weakref.proxy(hotterDeployer)
 
     def on_created(self, event):
-        d = Deploy(self.hotterDeployer,
-                   event.src_path,
-                   self.hotterDeployer.tomcat_directory
-                   )
-        d.start()
+        if event.src_path.endswith('.war'):
+            self.hotterDeployer.deploy_queue.submit(event.src_path)
+
+    def on_moved(self, event):
+        # Wars written elsewhere and renamed into place
+        if event.dest_path.endswith('.war'):
+            self.hotterDeployer.deploy_queue.submit(event.dest_path)
+
+    def on_closed(self, event):
+        # Only emitted by watchdog versions supporting close-write events
+        if event.src_path.endswith('.war'):
+            self.hotterDeployer.deploy_queue.mark_closed(event.src_path)
 
 
 class OnTempDeployHandler(FileSystemEventHandler):
@@ -43,7 +62,7 @@ class OnTempDeployHandler(FileSystemEventHandler):
     def on_created(self, event):
         self.process_default(event)
 
-    def on_delete(self, event):
+    def on_deleted(self, event):
         self.process_default(event)
 
 
@@ -58,164 +77,292 @@ class OnWebappsDeployHandler(FileSystemEventHandler):
     def on_created(self, event):
         self.process_default(event)
 
-    def on_delete(self, event):
+    def on_deleted(self, event):
         self.process_default(event)
 
 
-class WorkSpaceHandler(FileSystemEventHandler):
-    def __init__(self, hotterDeployer):
-        super(WorkSpaceHandler, self).__init__()
-        self.hotterDeployer = weakref.proxy(hotterDeployer)
-
-    def dispatch(self, event):
-        LOG.debug('WorkSpaceHandler::dispatch {0} {1}'.format(event.src_path, event))
-        path = event.src_path
-        if (path.find('.svn') == -1 and
-                contains_path(path, 'src/main/webapp/WEB-INF')):
-            super(WorkSpaceHandler, self).dispatch(event)
-        else:
-            LOG.debug('WorkSpaceHandler::dispatch ignored {0}'.format(event.src_path))
-
-    def on_created(self, event):
-        self.process_default(event)
-
-    def on_delete(self, event):
-        self.process_default(event)
+class EventRouter(FileSystemEventHandler):
+    '''
+    The handler of the workspace watch.
 
-    def on_modified(self, event):
-        self.process_default(event)
+    Every event path is classified once into its module, area and relative
+    path, and handed to the first rule accepting it. Rules without an area
+    see every event, before the rules of the area the path is in. Moves are
+    routed for both their source and destination.
+    '''
+    def __init__(self, hotterDeployer, rules=None):
+        super(EventRouter, self).__init__()
+        self.hotterDeployer = weakref.proxy(hotterDeployer)
+        # area -> rules, in order
+        self._rules = {}
+        for rule in (DEFAULT_RULES if rules is None else rules):
+            self.add_rule(rule(self.hotterDeployer))
 
-    def process_default(self, event):
-        if event.src_path.endswith('.xml'):
-            LOG.debug('WorkSpaceHandler::process_default {0} {1}'.format(event.src_path, event))
-            self.hotterDeployer._scan_wd(self.hotterDeployer.workspace_directory)
+    def add_rule(self, rule):
+        self._rules.setdefault(rule.area, []).append(rule)
 
+    def dispatch(self, event):
+        self._route(event, event.src_path)
+        if event.event_type == EVENT_TYPE_MOVED:
+            self._route(event, event.dest_path)
+
+    def _route(self, event, path):
+        if path.find('.svn') != -1:
+            return
+        METRICS.inc('fs_events')
+        with METRICS.timed('portlet_lookup'):
+            location = self.hotterDeployer.workspace_index.classify(path)
+        with METRICS.timed('dispatch_filter'):
+            rule = self._match(event, path, location)
+        if rule is not None:
+            rule.handle(event, path, location)
+
+    def _match(self, event, path, location):
+        rules = self._rules.get(None, ())
+        if location is not None and location.area is not None:
+            rules = chain(rules, self._rules.get(location.area, ()))
+        for rule in rules:
+            if event.event_type in rule.event_types and rule.accepts(event, path, location):
+                return rule
+        return None
+
+
+class Rule(object):
+    '''
+    Handles the events of one kind of resource
+    '''
+    # The module area the rule applies to, None for anywhere
+    area = None
+    event_types = ALL_EVENT_TYPES
 
-class OnFileChangedHandler(FileSystemEventHandler):
     def __init__(self, hotterDeployer):
-        super(OnFileChangedHandler, self).__init__()
-        self.hotterDeployer = weakref.proxy(hotterDeployer)
-        extension = '.jsp,.js,.css,.tag,.vm,.jspf'
-        self.extensions = extension.split(',')
-
-    def dispatch(self, event):
-        path = event.src_path
-        print 'FF', os.sep
-        LOG.debug('OnFileChangedHandler::dispatch {0} {1}'.format(event.src_path, event))
-        if path.find('.svn') == -1 and contains_path(path, 'src/main/webapp'):
-            super(OnFileChangedHandler, self).dispatch(event)
+        self.hotterDeployer = hotterDeployer
+
+    def accepts(self, event, path, location):
+        return True
+
+    def handle(self, event, path, location):
+        raise NotImplementedError
+
+
+class ModuleStructureRule(Rule):
+    '''
+    Keeps the workspace index up to date when directories or pom.xml files
+    of the scanned tree appear, change or disappear
+    '''
+    def accepts(self, event, path, location):
+        if event.is_directory:
+            if event.event_type == EVENT_TYPE_MODIFIED:
+                return False
+        elif os.path.basename(path) != 'pom.xml':
+            return False
+        # Not below module areas, target or node_modules
+        return self.hotterDeployer.workspace_index.is_scanned_path(path)
+
+    def handle(self, event, path, location):
+        LOG.debug('ModuleStructureRule::handle {0} {1}'.format(path, event))
+        index = self.hotterDeployer.workspace_index
+        if event.is_directory:
+            invalidate_hook_cache()
+            if os.path.isdir(path):
+                index.scan(path)
+            else:
+                index.remove_tree(path)
         else:
-            LOG.debug('OnFileChangedHandler::dispatch ignored {0}'.format(event.src_path))
-
-    def on_modified(self, event):
-        cwd = event.src_path.split(normalize_path('/src/main/webapp'))[0]
-
-        # Handle portlets
-        portlet_name = self.hotterDeployer.portlets.get(cwd, None)
-        if portlet_name:
-            if all(not event.src_path.endswith(ext) for ext in self.extensions):
-                return
-            rel_path = event.src_path.split(cwd+normalize_path('/src/main/webapp'))[1][1:]
-
+            index.update_module(os.path.dirname(path))
+
+
+class DescriptorRule(Rule):
+    '''
+    Re-reads a module when the xml descriptors in its WEB-INF change
+    '''
+    area = WEBAPP_AREA
+
+    def accepts(self, event, path, location):
+        return path.endswith('.xml') and location.rel_path.split(os.sep)[0] == 'WEB-INF'
+
+    def handle(self, event, path, location):
+        LOG.debug('DescriptorRule::handle {0} {1}'.format(path, event))
+        if os.path.basename(path) == 'liferay-hook.xml':
+            invalidate_hook_cache(location.module_root)
+        self.hotterDeployer.workspace_index.update_module(location.module_root)
+
+
+class WebappResourceRule(Rule):
+    '''
+    Hot-copies jsps, javascript and stylesheets, compiling the latter
+    '''
+    area = WEBAPP_AREA
+    event_types = (EVENT_TYPE_MODIFIED,)
+    extensions = HOT_COPY_EXTENSIONS
+
+    def accepts(self, event, path, location):
+        return not event.is_directory and path.endswith(self.extensions)
+
+    def handle(self, event, path, location):
+        self.hotterDeployer.coalescer.add(
+            location.portlet_name,
+            path,
+            partial(self.process, path, location)
+        )
+
+    def resolve(self, cwd, portlet_name, rel_path):
+        '''
+        Where a file of the webapp area is deployed: the directory, the path
+        relative to it and whether a hook overrides a portal file with it.
+        The directory is None when the module is not deployed.
+        '''
+        with METRICS.timed('hook_check'):
             jsp_hook = is_jsp_hook(cwd, rel_path)
-            if jsp_hook:
-                print 'JSP HOOK', rel_path
-                rel_path = jsp_hook
-                latest_subdir = self.hotterDeployer.liferay_dir
-                dest_path = os.path.join(latest_subdir, rel_path)
-                print dest_path
-                if not os.path.exists(dest_path+'.hotterdeploy'):
-                    shutil.copy2(dest_path, dest_path+'.hotterdeploy')
-            else:
-                # Find latest dir
-                latest_subdir = self.hotterDeployer.find_latest_temp_dir(portlet_name)
-
+        if not jsp_hook:
+            return self.hotterDeployer.find_latest_temp_dir(portlet_name), rel_path, False
+
+        LOG.debug('JSP HOOK {0}'.format(rel_path))
+        latest_subdir = self.hotterDeployer.liferay_dir
+        dest_path = os.path.join(latest_subdir, jsp_hook)
+        if os.path.exists(dest_path) and not os.path.exists(dest_path+'.hotterdeploy'):
+            shutil.copy2(dest_path, dest_path+'.hotterdeploy')
+        return latest_subdir, jsp_hook, True
+
+    def process(self, src_path, location):
+        cwd, portlet_name = location.module_root, location.portlet_name
+        latest_subdir, rel_path, jsp_hook = self.resolve(cwd, portlet_name, location.rel_path)
+
+        if not latest_subdir:
+            LOG.debug('- Skipped {0} ({1} not deployed)'.format(rel_path, portlet_name))
+            return None
+
+        if rel_path.endswith(('.css', '.scss')):
+            return self.process_stylesheet(src_path, cwd, portlet_name)
+
+        file_sync = self.hotterDeployer.file_sync
+        dest_path = os.path.join(latest_subdir, rel_path)
+        LOG.info('- Copying {0} ({1}) [{2}]'.format(rel_path, portlet_name, os.path.basename(latest_subdir)))
+        changed = file_sync.sync_file(src_path, dest_path)
+
+        if rel_path.endswith('.js') and self.hotterDeployer.statics_directory:
+            dest_path = os.path.join(self.hotterDeployer.statics_directory, portlet_name, rel_path)
+            changed = file_sync.sync_file(src_path, dest_path) or changed
+
+        # Identical content, nothing for tomcat or the browser to pick up
+        if not changed:
+            return None
+        return RELOAD_PORTAL if jsp_hook else RELOAD_ALL
+
+    def process_stylesheet(self, src_path, cwd, portlet_name):
+        '''
+        Compile a changed stylesheet, and every stylesheet importing it,
+        each into where it is deployed
+        '''
+        sass_cache = self.hotterDeployer.sass_cache
+        webapp_path = os.path.join(cwd, WEBAPP_AREA)
+        if sassc.is_partial(src_path) and not sass_cache.dependents(src_path):
+            # Learn the import graphs of the module the first time around
+            for entry in sassc.find_stylesheets(webapp_path):
+                try:
+                    sass_cache.register(entry)
+                except (IOError, OSError):
+                    LOG.debug('Could not read {0}'.format(entry), exc_info=True)
+
+        entries = [] if sassc.is_partial(src_path) else [src_path]
+        entries += sass_cache.dependents(src_path)
+
+        reload_paths = []
+        for entry in entries:
+            rel_path = os.path.relpath(entry, webapp_path)
+            if rel_path.startswith(os.pardir):
+                continue
+            if rel_path.endswith('.scss'):
+                rel_path = rel_path[:-len('.scss')] + '.css'
+            latest_subdir, rel_path, jsp_hook = self.resolve(cwd, portlet_name, rel_path)
             if not latest_subdir:
-                LOG.debug('- Skipped {0} ({1} not deployed)'.format(rel_path, portlet_name))
-            else:
-                dest_path = os.path.join(latest_subdir, rel_path)
-                LOG.info('- Copying {0} ({1}) [{2}]'.format(rel_path, portlet_name, os.path.basename(latest_subdir)))
-                if not os.path.exists(os.path.dirname(dest_path)):
-                    os.makedirs(os.path.dirname(dest_path))
-                print 'dest_path', dest_path
-
-                if rel_path.endswith('.js'):
-                    shutil.copy2(event.src_path, dest_path)
-                    if self.hotterDeployer.statics_directory:
-                        dest_path = os.path.join(self.hotterDeployer.statics_directory, portlet_name, rel_path)
-                        if not os.path.exists(os.path.dirname(dest_path)):
-                            os.makedirs(os.path.dirname(dest_path))
-                        shutil.copy2(event.src_path, dest_path)
-                    self.hotterDeployer.trigger_browser_reload()
-                elif rel_path.endswith('.css'):
-                    #shutil.copy2(event.src_path, dest_path)
-                    try:
-                        print 'compiling scss'
-                        data = sassc.compile(event.src_path)
-
-                        with open(dest_path, 'wb') as f:
-                            f.write(data)
-
-                        # TODO: copy output
-                        # /home/sueastside/Projects/CreDoc/static - credoc-theme
-                        print 'output for portlet ', portlet_name, rel_path
-
-                        if self.hotterDeployer.statics_directory:
-                            dest_path = os.path.join(self.hotterDeployer.statics_directory, portlet_name, rel_path)
-
-                            if not os.path.exists(os.path.dirname(dest_path)):
-                                os.makedirs(os.path.dirname(dest_path))
-
-                            with open(dest_path, 'wb') as f:
-                                f.write(data)
-
-                        self.hotterDeployer.trigger_browser_reload(portlet_name+'/'+rel_path)
-                    except sassc.SassException as e:
-                        log.warn(e)
-
-                else:
-                    self.hotterDeployer.trigger_browser_reload()
-                    shutil.copy2(event.src_path, dest_path)
-
-
-class OnClassChangedHandler(FileSystemEventHandler):
-    def __init__(self, hotterDeployer):
-        super(OnClassChangedHandler, self).__init__()
-        self.hotterDeployer = weakref.proxy(hotterDeployer)
-
-    def dispatch(self, event):
-        path = event.src_path
-        if (path.find('.svn') == -1
-            and path.find('target/classes') != -1
-            and os.path.isfile(path)):
-                super(OnClassChangedHandler, self).dispatch(event)
-
-    def on_modified(self, event):
-        cwd = event.src_path.split('/target/classes')[0]
-
-        # Handle portlets
-        portlet_name = self.hotterDeployer.portlets.get(cwd, None)
-        print 'portlet_name', portlet_name
-        if portlet_name:
-            rel_path = event.src_path.split(cwd+'/target/classes')[1][1:]
-            print rel_path
-
-            latest_subdir = self.hotterDeployer.find_latest_temp_dir(portlet_name)
-
-            print 'rel_path', rel_path
-
-            if not latest_subdir:
-                print '- Skipped {0} ({1} not deployed)'.format(rel_path, portlet_name)
-            else:
-                dest_path = os.path.join(latest_subdir, 'WEB-INF', 'classes', rel_path)
-                print '- Copying {0} ({1}) [{2}]'.format(rel_path, portlet_name, os.path.basename(latest_subdir))
-                if not os.path.exists(os.path.dirname(dest_path)):
-                    os.makedirs(os.path.dirname(dest_path))
-                print 'OnClassChangedHandler::on_modified', dest_path
-                shutil.copy2(event.src_path, dest_path)
-
-                # self.hotterDeployer.trigger_browser_reload()
-
-                from threading import Timer
-                t = Timer(1.2, self.hotterDeployer.trigger_browser_reload)
-                t.start()
+                continue
+
+            with METRICS.timed('scss_digest'):
+                digest = sass_cache.digest(entry)
+            data = sass_cache.lookup(digest)
+            METRICS.inc('scss_cache_misses' if data is None else 'scss_cache_hits')
+            if data is None:
+                # Compiled off-thread, the browser is reloaded once it is done
+                LOG.debug('Compiling scss {0}'.format(entry))
+                self.hotterDeployer.sass_compiler.submit(
+                    entry, digest,
+                    partial(self._stylesheet_compiled, digest, rel_path, portlet_name, latest_subdir, jsp_hook)
+                )
+                continue
+
+            if self.write_stylesheet(data, rel_path, portlet_name, latest_subdir):
+                # Hooks change the portal, every page may show the stylesheet
+                reload_paths.append(RELOAD_PORTAL if jsp_hook else portlet_name+'/'+rel_path.replace(os.sep, '/'))
+
+        if RELOAD_PORTAL in reload_paths:
+            return RELOAD_PORTAL
+        if len(reload_paths) > 1:
+            return RELOAD_STYLESHEETS
+        return reload_paths[0] if reload_paths else None
+
+    def _stylesheet_compiled(self, digest, rel_path, portlet_name, latest_subdir, jsp_hook, data):
+        self.hotterDeployer.sass_cache.store(digest, data)
+        try:
+            changed = self.write_stylesheet(data, rel_path, portlet_name, latest_subdir)
+        except (IOError, OSError):
+            LOG.exception('Failed to write {0}'.format(rel_path))
+            return
+        if not changed:
+            return
+        if jsp_hook:
+            self.hotterDeployer.trigger_browser_reload()
+        else:
+            self.hotterDeployer.trigger_browser_reload(portlet_name+'/'+rel_path.replace(os.sep, '/'), portlet_name)
+
+    def write_stylesheet(self, data, rel_path, portlet_name, latest_subdir):
+        '''
+        Returns whether the output differed from what was deployed
+        '''
+        file_sync = self.hotterDeployer.file_sync
+        changed = file_sync.write_file(data, os.path.join(latest_subdir, rel_path))
+
+        if self.hotterDeployer.statics_directory:
+            dest_path = os.path.join(self.hotterDeployer.statics_directory, portlet_name, rel_path)
+            changed = file_sync.write_file(data, dest_path) or changed
+        return changed
+
+
+class CompiledClassRule(Rule):
+    '''
+    Hot-copies classes, for Spring Loaded to pick up
+    '''
+    area = CLASSES_AREA
+    event_types = (EVENT_TYPE_MODIFIED,)
+
+    def accepts(self, event, path, location):
+        return not event.is_directory
+
+    def handle(self, event, path, location):
+        # Give Spring Loaded time to pick up the batch before reloading
+        self.hotterDeployer.coalescer.add(
+            location.portlet_name,
+            path,
+            partial(self.process, path, location),
+            reload_delay=SPRING_LOADED_SETTLE_TIME
+        )
+
+    def process(self, src_path, location):
+        portlet_name, rel_path = location.portlet_name, location.rel_path
+        if not os.path.isfile(src_path):
+            return None
+
+        latest_subdir = self.hotterDeployer.find_latest_temp_dir(portlet_name)
+
+        if not latest_subdir:
+            LOG.debug('- Skipped {0} ({1} not deployed)'.format(rel_path, portlet_name))
+            return None
+
+        dest_path = os.path.join(latest_subdir, 'WEB-INF', 'classes', rel_path)
+        LOG.info('- Copying {0} ({1}) [{2}]'.format(rel_path, portlet_name, os.path.basename(latest_subdir)))
+        if not self.hotterDeployer.file_sync.sync_file(src_path, dest_path):
+            return None
+        return RELOAD_ALL
+
+
+DEFAULT_RULES = [ModuleStructureRule, DescriptorRule, WebappResourceRule, CompiledClassRule]
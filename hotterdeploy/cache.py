@@ -0,0 +1,96 @@
+'''
+On-disk cache of the startup scans.
+
+Stores the workspace walk state and the tomcat temp/webapps listings, so a
+restart only has to re-read what changed since the last run, and the
+descriptors of the wars deployed, to know which wars can be patched in.
+'''
+
+import os
+import sys
+import json
+import hashlib
+import logging
+from threading import Lock
+
+LOG = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+def default_cache_path(cache_directory, workspace_directory, tomcat_directory):
+    '''
+    One cache file per workspace/tomcat combination
+    '''
+    key = '{0}|{1}'.format(os.path.abspath(workspace_directory), os.path.abspath(tomcat_directory))
+    return os.path.join(cache_directory, 'cache-{0}.json'.format(hashlib.md5(key).hexdigest()))
+
+
+def _native(value):
+    # json hands back unicode, paths from os.listdir are str
+    if isinstance(value, dict):
+        return dict((_native(k), _native(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_native(v) for v in value]
+    if isinstance(value, unicode):
+        return value.encode(sys.getfilesystemencoding() or 'utf-8')
+    return value
+
+
+def list_subdirectories(directory, cached=None):
+    '''
+    List the subdirectories of a directory, reusing a cached listing
+    when the directory mtime did not change.
+    Returns the state to cache and the subdirectory names.
+    '''
+    mtime = os.stat(directory).st_mtime
+    if cached and cached[0] == mtime:
+        return cached, cached[1]
+    names = [name for name in os.listdir(directory) if os.path.isdir(os.path.join(directory, name))]
+    return [mtime, names], names
+
+
+class StartupCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        # Deploy workers save too
+        self._lock = Lock()
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return self
+        try:
+            with open(self.path, 'rb') as f:
+                data = _native(json.load(f))
+            if data.get('version') == CACHE_VERSION:
+                self.data = data
+            else:
+                LOG.debug('Ignoring outdated cache {0}'.format(self.path))
+        except (IOError, ValueError):
+            LOG.warn('Ignoring unreadable cache {0}'.format(self.path))
+        return self
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def save(self):
+        if not self.path:
+            return
+        self.data['version'] = CACHE_VERSION
+        directory = os.path.dirname(self.path)
+        with self._lock:
+            try:
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    json.dump(self.data, f)
+                if os.name == 'nt' and os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError):
+                LOG.warn('Could not write cache {0}'.format(self.path), exc_info=True)
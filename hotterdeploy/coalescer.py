@@ -0,0 +1,178 @@
+'''
+Coalesces hot-copy work coming from the watchdog observer.
+
+Events are collected per portlet until no new event arrived for that
+portlet during the quiet window. Duplicate events for the same path are
+dropped, the batch is processed in one go and a single browser reload is
+sent for the whole batch. Delayed reloads are scheduled on the IOLoop of
+the livereload server, with one restartable deadline per portlet.
+'''
+
+import time
+import logging
+from datetime import timedelta
+from functools import partial
+from collections import OrderedDict
+from threading import Thread, Condition
+
+from tornado.ioloop import IOLoop
+
+from .metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+RELOAD_ALL = '*'
+# Matches no stylesheet in particular, so liveCSS swaps all of them in place
+RELOAD_STYLESHEETS = '*.css'
+# Changes to the portal itself (hooks), reloads every page not just the
+# ones showing the portlet
+RELOAD_PORTAL = '**'
+# Time Spring Loaded needs to pick up changed classes before a reload shows them
+SPRING_LOADED_SETTLE_TIME = 1.2
+
+
+def merge_reload_paths(reload_paths):
+    '''
+    A single targeted path or only stylesheets keeps liveCSS working,
+    anything else reloads the page (None)
+    '''
+    reload_paths = set(reload_paths)
+    if len(reload_paths) == 1:
+        reload_path = reload_paths.pop()
+        return None if reload_path == RELOAD_ALL else reload_path
+    if reload_paths and all(path and path.endswith('.css') for path in reload_paths):
+        return RELOAD_STYLESHEETS
+    return None
+
+
+class Batch(object):
+    def __init__(self, portlet_name):
+        self.portlet_name = portlet_name
+        self.actions = OrderedDict()
+        self.first_event = time.time()
+        self.deadline = 0
+        self.reload_delay = 0
+
+
+class EventCoalescer(Thread):
+    '''
+    Batches actions per portlet over a quiet window.
+
+    An action is a callable returning the path to reload, RELOAD_STYLESHEETS
+    to reload all stylesheets, RELOAD_ALL for a full page reload or None when
+    nothing needs reloading.
+    '''
+    def __init__(self, hotterDeployer_weakref, quiet_window=0.2):
+        super(EventCoalescer, self).__init__(name='EventCoalescer')
+        self.daemon = True
+        self.hotterDeployer = hotterDeployer_weakref
+        self.quiet_window = quiet_window
+        self._batches = {}
+        self._condition = Condition()
+        self._running = True
+
+    def add(self, portlet_name, path, action, reload_delay=0):
+        METRICS.inc('events')
+        with self._condition:
+            batch = self._batches.get(portlet_name)
+            if batch is None:
+                batch = self._batches[portlet_name] = Batch(portlet_name)
+            # Only the latest event for a path is kept
+            batch.actions.pop(path, None)
+            batch.actions[path] = action
+            batch.deadline = time.time() + self.quiet_window
+            batch.reload_delay = max(batch.reload_delay, reload_delay)
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                batches = self._wait_for_due_batches()
+            if batches is None:
+                return
+            for batch in batches:
+                self._flush(batch)
+
+    def _wait_for_due_batches(self):
+        while self._running:
+            now = time.time()
+            due = [batch for batch in self._batches.values() if batch.deadline <= now]
+            if due:
+                for batch in due:
+                    del self._batches[batch.portlet_name]
+                return due
+            timeout = None
+            if self._batches:
+                timeout = min(batch.deadline for batch in self._batches.values()) - now
+            self._condition.wait(timeout)
+        return None
+
+    def _flush(self, batch):
+        METRICS.inc('batches')
+        METRICS.observe('batch_wait', time.time() - batch.first_event)
+        reload_paths = set()
+        with METRICS.timed('batch_process'):
+            for path, action in batch.actions.items():
+                try:
+                    reload_path = action()
+                except Exception:
+                    LOG.exception('Failed to process {0}'.format(path))
+                    continue
+                if reload_path:
+                    reload_paths.add(reload_path)
+
+        LOG.debug('Processed {0} file(s) for {1}'.format(len(batch.actions), batch.portlet_name))
+        if not reload_paths:
+            return
+
+        scoped = RELOAD_PORTAL not in reload_paths
+        if not scoped:
+            reload_paths.discard(RELOAD_PORTAL)
+            reload_paths.add(RELOAD_ALL)
+
+        reload_path = merge_reload_paths(reload_paths)
+        # Save to reload, the Spring Loaded settle time excluded
+        METRICS.observe('event_to_reload', time.time() - batch.first_event)
+        if batch.reload_delay:
+            self.hotterDeployer.reload_scheduler.schedule(batch.portlet_name, batch.reload_delay, reload_path, scoped)
+        else:
+            self.hotterDeployer.trigger_browser_reload(reload_path, batch.portlet_name if scoped else None)
+
+
+class ReloadScheduler(object):
+    '''
+    Delayed browser reloads on the IOLoop, at most one pending per portlet.
+    Scheduling a portlet again pushes its deadline back, so however long a
+    rebuild keeps changing files only one reload goes out once it settled.
+    '''
+    def __init__(self, hotterDeployer_weakref, io_loop=None):
+        self.hotterDeployer = hotterDeployer_weakref
+        self._io_loop = io_loop or IOLoop.instance()
+        # portlet -> (timeout handle, reload path, scoped), only touched on the IOLoop
+        self._pending = {}
+
+    def schedule(self, portlet_name, delay, reload_path=None, scoped=True):
+        '''
+        Safe to call from any thread. Scoped reloads only go to the pages
+        showing the portlet.
+        '''
+        self._io_loop.add_callback(self._schedule, portlet_name, delay, reload_path, scoped)
+
+    def _schedule(self, portlet_name, delay, reload_path, scoped):
+        pending = self._pending.pop(portlet_name, None)
+        if pending is not None:
+            handle, pending_path, pending_scoped = pending
+            self._io_loop.remove_timeout(handle)
+            reload_path = merge_reload_paths([pending_path or RELOAD_ALL, reload_path or RELOAD_ALL])
+            scoped = scoped and pending_scoped
+        handle = self._io_loop.add_timeout(timedelta(seconds=delay), partial(self._fire, portlet_name))
+        self._pending[portlet_name] = (handle, reload_path, scoped)
+
+    def _fire(self, portlet_name):
+        handle, reload_path, scoped = self._pending.pop(portlet_name)
+        self.hotterDeployer.trigger_browser_reload(reload_path, portlet_name if scoped else None)
@@ -1,22 +1,51 @@
 import os
 import shutil
+import posixpath
 import re
-import datetime
 import logging
 import binascii
-from pyjavaproperties import Properties
+import time
+import datetime
+from collections import OrderedDict
 from xml.dom import minidom
-from zipfile import ZipFile
-from threading import Thread
+from threading import Thread, Lock, Condition
+from multiprocessing.pool import ThreadPool
+
+from .logtail import LogTailer
+from .metrics import METRICS
+from .coalescer import SPRING_LOADED_SETTLE_TIME
 
 LOG = logging.getLogger(__name__)
 
+DEPLOY_TIMEOUT = 60
+
+# Waiting for wars to be completely written
+WAR_POLL_INTERVAL = 0.25
+WAR_QUIET_PERIOD = 1.0
+WAR_READY_TIMEOUT = 300
+WAR_WRITING, WAR_READY, WAR_GONE = range(3)
+
+# Liferay 6.1 hack, it does not log the portlet being available. These lines
+# do not name the portlet, so they only count while a single deploy waits,
+# see LogTailer.fallback_lock
+LIFERAY_61_PATTERNS = [
+    'Initializing Spring root WebApplicationContext',
+    'Closing Spring root WebApplicationContext',
+]
+
+# Only read when the context starts, see is_descriptor
+DESCRIPTOR_DIRECTORIES = ('WEB-INF', 'WEB-INF/tld')
+DESCRIPTOR_PREFIXES = ('META-INF/', 'WEB-INF/classes/META-INF/')
+# portlet.properties, service.properties and the like are read once per context
+DESCRIPTOR_PROPERTIES = 'WEB-INF/classes'
+HOOK_DESCRIPTOR = 'WEB-INF/liferay-hook.xml'
+
 
 class DeploymentTimedOutException(Exception):
     pass
 
 
-class Deploy(Thread):
+class Deploy(object):
     '''
     Conditionally deploy a portlet war
     '''
@@ -24,9 +53,16 @@ class Deploy(Thread):
         self.hotterDeployer = hotterDeployer_weakref
         self.war_path = war_path
         self.tomcat_directory = tomcat_directory
-        super(Deploy, self).__init__()
+        self.bundle_name = self._get_bundle_name()
+        self.queued_at = datetime.datetime.now()
+        self.started_at = None
+        # Write completion tracking, see DeployQueue
+        self.closed = False
+        self.written_stat = None
+        self.stable_since = None
 
     def _get_portlet_name(self):
+        from zipfile import ZipFile
         with ZipFile(self.war_path, 'r') as war:
             with war.open('WEB-INF/portlet.xml') as xml:
                 xmldoc = minidom.parse(xml)
@@ -53,43 +89,67 @@ class Deploy(Thread):
         return True
 
     def _wait_for_string_in_log(self, string, action):
-        matcher = re.compile(string)
-        start = datetime.datetime.now()
-        catalina_log = format('logs/catalina.%s-%02d-%02d.out' % (start.year,start.month,start.day)) if os.name == 'nt' else 'logs/catalina.out'
-        with open(os.path.join(self.tomcat_directory, catalina_log)) as f:
-            # Start listening to the log
-            f.seek(0, 2)  # go to end
-            p = f.tell()
+        tailer = LogTailer.for_tomcat(self.tomcat_directory)
+        if tailer.names_lines:
+            return self._wait_for_line(tailer, string, action, ())
+        # Possibly Liferay 6.1, deploys wait one at a time so the fallback
+        # lines can be told apart
+        with tailer.fallback_lock:
+            return self._wait_for_line(tailer, string, action, LIFERAY_61_PATTERNS)
+
+    def _wait_for_line(self, tailer, string, action, fallback_patterns):
+        # Start listening to the log before acting
+        waiter = tailer.expect([string], fallback_patterns)
+        try:
             if action():
-                while True:
-                    f.seek(p)
-                    latest_data = f.read()
-                    p = f.tell()
-                    if latest_data:
-                        # print latest_data
-                        # print str(p).center(10).center(80, '=')
-                        print '.',
-                        if matcher.search(latest_data):
-                            break
-
-                        # Liferay 6.1 hack
-                        if latest_data.find('Initializing Spring root WebApplicationContext'):
-                            break
-                        if latest_data.find('Closing Spring root WebApplicationContext'):
-                            break
-
-                    elapsed = datetime.datetime.now() - start
-                    if elapsed > datetime.timedelta(minutes=1):
-                        raise DeploymentTimedOutException()
+                if not waiter.wait(DEPLOY_TIMEOUT):
+                    raise DeploymentTimedOutException()
+        finally:
+            tailer.cancel(waiter)
+
+    def _patch(self, latest_dir, jars, descriptors):
+        '''
+        Write what changed in the war into the deployed directory instead
+        of deploying it, returns False when the war has to be deployed
+        '''
+        bundle_name = self.bundle_name
+        if HOOK_DESCRIPTOR in descriptors:
+            # Hooks change the portal, not their own directory
+            return False
+        if not libs_unchanged(jars):
+            LOG.info('Libraries of {0} changed, deploying the war'.format(bundle_name))
+            return False
+        if descriptors != self.hotterDeployer.deployed_descriptors(bundle_name):
+            LOG.info('Descriptors of {0} changed or unknown, deploying the war'.format(bundle_name))
+            return False
+
+        with METRICS.timed('delta_deploy'):
+            written = patch_war(self.war_path, latest_dir, self.hotterDeployer.file_sync,
+                                self.hotterDeployer.statics_directory, bundle_name)
+        os.remove(self.war_path)
+        METRICS.inc('delta_deploys')
+        LOG.info('Patched {0} file(s) of {1} [{2}]'.format(len(written), bundle_name, os.path.basename(latest_dir)))
+
+        if any(name.startswith('WEB-INF/classes/') for name in written):
+            # Give Spring Loaded time to pick up the classes before reloading
+            self.hotterDeployer.reload_scheduler.schedule(bundle_name, SPRING_LOADED_SETTLE_TIME)
+        elif written:
+            self.hotterDeployer.trigger_browser_reload(None, bundle_name)
+        return True
 
     def do(self):
-        bundle_name = self._get_bundle_name()
+        bundle_name = self.bundle_name
         latest_dir = self.hotterDeployer.find_latest_temp_dir(bundle_name)
+        descriptors = war_descriptors(self.war_path) if self.hotterDeployer.delta_deploy else None
 
         try:
             if latest_dir:
                 # The portlet seems to be deployed, let's compare
-                needs_undeploy = check_for_lib_diffs(self.war_path, latest_dir)
+                with METRICS.timed('lib_diff'):
+                    jars = diff_libs(self.war_path, latest_dir)
+                if descriptors is not None and self._patch(latest_dir, jars, descriptors):
+                    return
+                needs_undeploy = report_lib_diffs(jars)
                 if needs_undeploy:
                     # We found lib differences
                     # We undeployed, now wait for LifeRay to notice
@@ -98,30 +158,248 @@ class Deploy(Thread):
 
             LOG.info('Deploying {0}'.format(bundle_name))
             self._wait_for_string_in_log('for '+bundle_name+' (\w+) available for use', lambda: self._deploy())
-            self.hotterDeployer.trigger_browser_reload()
+            if descriptors is not None:
+                # What later wars of this bundle can be patched against
+                self.hotterDeployer.remember_descriptors(bundle_name, descriptors)
+            self.hotterDeployer.trigger_browser_reload(None, bundle_name)
         except DeploymentTimedOutException:
+            METRICS.inc('deploy_failures')
             LOG.error('Deployment of {0} failed!!!'.format(bundle_name))
 
-    def run(self):
-        self.do()
 
+def is_complete_war(path):
+    '''
+    Whether the zip central directory of a war can be read
+    '''
+    from zipfile import ZipFile, BadZipfile
+    try:
+        with ZipFile(path, 'r') as war:
+            war.infolist()
+        return True
+    except (BadZipfile, IOError, OSError):
+        return False
+
+
+class DeployQueue(object):
+    '''
+    Runs deploys on a fixed number of workers, never two of the same bundle
+    at once. A war still waiting in the queue is dropped when a newer war of
+    the same bundle arrives.
 
-def check_for_lib_diffs(war_path, temp_portlet_path):
+    Submitted wars are only queued once they are completely written: their
+    size and mtime did not change for a while (or the writer closed them)
+    and their zip central directory can be read.
     '''
-    Checks whether the jars in a war and on a deployed path are the same
+    def __init__(self, hotterDeployer_weakref, tomcat_directory, workers=2):
+        self.hotterDeployer = hotterDeployer_weakref
+        self.tomcat_directory = tomcat_directory
+        self._condition = Condition()
+        # war path -> Deploy, still being written
+        self._pending = {}
+        # bundle name -> Deploy, in arrival order
+        self._queued = OrderedDict()
+        self._running = {}
+        self._stopped = False
+        self._workers = []
+        for i in range(max(1, workers)):
+            worker = Thread(target=self._work, name='DeployWorker-{0}'.format(i))
+            worker.daemon = True
+            self._workers.append(worker)
+        self._readiness = Thread(target=self._wait_for_wars, name='DeployReadiness')
+        self._readiness.daemon = True
+
+    def start(self):
+        self._readiness.start()
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def submit(self, war_path):
+        deploy = Deploy(self.hotterDeployer, war_path, self.tomcat_directory)
+        with self._condition:
+            LOG.debug('Waiting for {0} to be written'.format(war_path))
+            self._pending[war_path] = deploy
+            self._condition.notify_all()
+        return deploy
+
+    def mark_closed(self, war_path):
+        '''
+        The writer closed the war, no need to wait for it to settle
+        '''
+        with self._condition:
+            deploy = self._pending.get(war_path)
+            if deploy:
+                deploy.closed = True
+                self._condition.notify_all()
+
+    def _enqueue(self, deploy):
+        war_path = deploy.war_path
+        with self._condition:
+            older = self._queued.pop(deploy.bundle_name, None)
+            if older:
+                LOG.info('Dropping {0}, superseded by {1}'.format(
+                    os.path.basename(older.war_path), os.path.basename(war_path)))
+                if older.war_path != war_path and os.path.exists(older.war_path):
+                    os.remove(older.war_path)
+            self._queued[deploy.bundle_name] = deploy
+            LOG.info('Queued {0} ({1} queued, {2} running)'.format(
+                deploy.bundle_name, len(self._queued), len(self._running)))
+            self._condition.notify_all()
+
+    def _readiness_of(self, deploy):
+        now = time.time()
+        try:
+            st = os.stat(deploy.war_path)
+        except OSError:
+            LOG.debug('{0} disappeared'.format(deploy.war_path))
+            return WAR_GONE
+
+        written_stat = (st.st_size, st.st_mtime)
+        if written_stat != deploy.written_stat:
+            deploy.written_stat = written_stat
+            deploy.stable_since = now
+        if not deploy.closed and now - deploy.stable_since < WAR_QUIET_PERIOD:
+            return WAR_WRITING
+
+        if is_complete_war(deploy.war_path):
+            return WAR_READY
+
+        # Closed or quiet but not a valid zip (yet), keep waiting for changes
+        deploy.closed = False
+        if now - deploy.stable_since > WAR_READY_TIMEOUT:
+            LOG.error('{0} is not a valid war, not deploying it'.format(deploy.war_path))
+            return WAR_GONE
+        return WAR_WRITING
+
+    def _wait_for_wars(self):
+        while True:
+            with self._condition:
+                while not self._stopped and not self._pending:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                pending = list(self._pending.values())
+
+            # Stat and zip checks happen outside of the lock
+            states = [(deploy, self._readiness_of(deploy)) for deploy in pending]
+
+            with self._condition:
+                for deploy, state in states:
+                    if state == WAR_WRITING or self._pending.get(deploy.war_path) is not deploy:
+                        continue
+                    del self._pending[deploy.war_path]
+                    if state == WAR_READY:
+                        self._enqueue(deploy)
+                self._condition.wait(WAR_POLL_INTERVAL)
+
+    def status(self):
+        '''
+        Snapshot of the pending, running and queued deploys
+        '''
+        with self._condition:
+            return {
+                'pending': list(self._pending.values()),
+                'running': list(self._running.values()),
+                'queued': list(self._queued.values()),
+            }
+
+    def _next(self):
+        for bundle_name, deploy in self._queued.items():
+            if bundle_name not in self._running:
+                return deploy
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                deploy = self._next()
+                while not self._stopped and deploy is None:
+                    self._condition.wait()
+                    deploy = self._next()
+                if self._stopped:
+                    return
+                del self._queued[deploy.bundle_name]
+                self._running[deploy.bundle_name] = deploy
+
+            deploy.started_at = datetime.datetime.now()
+            METRICS.observe('deploy_queued', (deploy.started_at - deploy.queued_at).total_seconds())
+            METRICS.inc('deploys')
+            try:
+                with METRICS.timed('deploy'):
+                    deploy.do()
+            except Exception:
+                METRICS.inc('deploy_failures')
+                LOG.exception('Deployment of {0} failed'.format(deploy.bundle_name))
+            finally:
+                with self._condition:
+                    del self._running[deploy.bundle_name]
+                    self._condition.notify_all()
+
+
+LR_DEP = 'LR_DEP'
+CHUNK_SIZE = 1024 * 1024
+HASH_THREADS = 4
+
+# path -> (mtime, size, crc32) of deployed jars
+_crc_cache = {}
+_crc_cache_lock = Lock()
+
+
+def stream_crc32(path):
+    '''
+    Crc32 of a file, read in chunks
+    '''
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            crc = binascii.crc32(chunk, crc)
+    return crc & 0xffffffff
+
+
+def file_crc32(path, st=None):
+    '''
+    Streamed crc32 of a deployed jar, cached as long as its mtime and size
+    stay the same
+    '''
+    st = st or os.stat(path)
+    with _crc_cache_lock:
+        cached = _crc_cache.get(path)
+    if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        return cached[2]
+
+    crc = stream_crc32(path)
+    with _crc_cache_lock:
+        _crc_cache[path] = (st.st_mtime, st.st_size, crc)
+    return crc
+
+
+def diff_libs(war_path, temp_portlet_path):
+    '''
+    Compares the jars in a war with the ones on a deployed path, returns
+    jar -> True when unchanged, False when out of date, None when missing,
+    'lingering' when only deployed and LR_DEP when provided by Liferay
     '''
     jars = {}
-    # Calculate crc32 for all deployed jars
+    # Stat all deployed jars
+    deployed = {}
     webinf_lib_dir = os.path.join(temp_portlet_path, 'WEB-INF/lib/')
     if os.path.exists(webinf_lib_dir):
         for lib in os.listdir(webinf_lib_dir):
-            path = os.path.join(temp_portlet_path, 'WEB-INF/lib/', lib)
+            path = os.path.join(webinf_lib_dir, lib)
             if os.path.isfile(path):
-                with open(os.path.join(temp_portlet_path, 'WEB-INF/lib/', lib)) as jar:
-                    jars['WEB-INF/lib/'+lib] = binascii.crc32(jar.read())
+                deployed['WEB-INF/lib/'+lib] = (path, os.stat(path))
+                jars['WEB-INF/lib/'+lib] = 'lingering'
             else:
                 jars['WEB-INF/lib/'+lib] = None  # directory assume changed
 
+    # Loaded on first deploy, not needed to start up
+    from zipfile import ZipFile
+    from pyjavaproperties import Properties
+
     # Process the war to be deployed
     with ZipFile(war_path, 'r') as war:
         # Process liferay dependencies
@@ -136,24 +414,53 @@ def check_for_lib_diffs(war_path, temp_portlet_path):
         except KeyError:
             pass
         for jar in dep_jars:
-            jars['WEB-INF/lib/'+jar] = 'LR_DEP'
+            jars['WEB-INF/lib/'+jar] = LR_DEP
 
-        # Calculate crc32 for jars in war
-        for info in war.infolist():
-            if info.filename.startswith('WEB-INF/lib/') and not info.filename == 'WEB-INF/lib/':
-                    crc = jars.get(info.filename, None)
-                    if crc:
-                        with war.open(info.filename) as lib:
-                            crco = binascii.crc32(lib.read())  # info.CRC
-                        jars[info.filename] = crco == crc
-                    else:
-                        jars[info.filename] = None
+        # The war already knows the size and crc32 of its jars
+        war_jars = [info for info in war.infolist()
+                    if info.filename.startswith('WEB-INF/lib/') and not info.filename == 'WEB-INF/lib/']
+
+    to_hash = []
+    for info in war_jars:
+        if jars.get(info.filename) == LR_DEP:
+            continue
+        if info.filename not in deployed:
+            jars[info.filename] = None
+            continue
+        path, st = deployed[info.filename]
+        if st.st_size != info.file_size:
+            jars[info.filename] = False
+        else:
+            to_hash.append((info.filename, path, st, info.CRC))
+
+    # Only jars with a matching size need their content compared
+    if to_hash:
+        def compare(entry):
+            filename, path, st, crc = entry
+            return filename, file_crc32(path, st) == crc
+
+        pool = ThreadPool(min(HASH_THREADS, len(to_hash)))
+        try:
+            jars.update(pool.map(compare, to_hash))
+        finally:
+            pool.close()
+    return jars
 
+
+def libs_unchanged(jars):
+    return all(state is True or state == LR_DEP for state in jars.values())
+
+
+def report_lib_diffs(jars):
+    '''
+    Logs the differences found by diff_libs, returns whether they need an
+    undeploy
+    '''
     # Iterate the file listing to check for missing/outdated/lingering
     # files
     needs_undeploy = False
     for filename, crc in jars.items():
-        if crc == 'LR_DEP':
+        if crc == LR_DEP:
             pass
         elif crc is True:
             pass
@@ -167,3 +474,65 @@ def check_for_lib_diffs(war_path, temp_portlet_path):
             needs_undeploy = True
 
     return needs_undeploy
+
+
+def check_for_lib_diffs(war_path, temp_portlet_path):
+    '''
+    Checks whether the jars in a war and on a deployed path are the same
+    '''
+    return report_lib_diffs(diff_libs(war_path, temp_portlet_path))
+
+
+def is_descriptor(name):
+    '''
+    Whether a war entry is only read when the context starts, changing it
+    needs a deploy
+    '''
+    directory = posixpath.dirname(name)
+    if directory == DESCRIPTOR_PROPERTIES and name.endswith('.properties'):
+        return True
+    return directory in DESCRIPTOR_DIRECTORIES or name.startswith(DESCRIPTOR_PREFIXES)
+
+
+def war_descriptors(war_path):
+    '''
+    Entry name -> crc32 of the descriptors in a war
+    '''
+    from zipfile import ZipFile
+    with ZipFile(war_path, 'r') as war:
+        return dict((info.filename, info.CRC) for info in war.infolist() if is_descriptor(info.filename))
+
+
+def patch_war(war_path, directory, file_sync, statics_directory=None, portlet_name=None):
+    '''
+    Writes the entries of a war, except its libraries and descriptors, that
+    differ in size or crc32 from the files in a deployed directory.
+    Files no longer in the war are left alone.
+    Returns the names of the entries written
+    '''
+    from zipfile import ZipFile
+    written = []
+    with ZipFile(war_path, 'r') as war:
+        for info in war.infolist():
+            name = info.filename
+            parts = name.split('/')
+            if (name.endswith('/') or name.startswith('WEB-INF/lib/') or
+                    is_descriptor(name) or os.pardir in parts or posixpath.isabs(name)):
+                continue
+
+            dest = os.path.join(directory, *parts)
+            try:
+                st = os.stat(dest)
+            except OSError:
+                st = None
+            # Not cached, a portlet has far more resources than jars and each
+            # one is only compared once per deploy
+            if st is not None and st.st_size == info.file_size and stream_crc32(dest) == info.CRC:
+                continue
+
+            data = war.read(name)
+            file_sync.write_file(data, dest)
+            if name.endswith('.js') and statics_directory:
+                file_sync.write_file(data, os.path.join(statics_directory, portlet_name, *parts))
+            written.append(name)
+    return written
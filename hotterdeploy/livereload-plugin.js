@@ -0,0 +1,54 @@
+/*
+ * Reports the contexts a page loads its resources from (e.g. /my-portlet/css/main.css)
+ * in the livereload info handshake, so hotterdeploy only reloads the pages
+ * showing a changed portlet. Picked up by livereload.js as a LiveReloadPlugin*.
+ */
+(function() {
+  var HotterDeployPlugin = function(window, host) {
+    this.window = window;
+    this.host = host;
+  };
+
+  HotterDeployPlugin.identifier = 'hotterdeploy';
+  HotterDeployPlugin.version = '1.0';
+
+  HotterDeployPlugin.prototype.reload = function(path, options) {
+    // Leave the actual reloading to livereload.js
+    return false;
+  };
+
+  HotterDeployPlugin.prototype.analyze = function() {
+    var elements = this.window.document.querySelectorAll('link[href], script[src], img[src]');
+    var origin = this.window.location.protocol + '//' + this.window.location.host + '/';
+    var seen = {};
+    var contexts = [];
+    var add = function(path) {
+      var context = path.split(/[\/?#&]/)[0];
+      if (context && !seen[context]) {
+        seen[context] = true;
+        contexts.push(context);
+      }
+    };
+    for (var i = 0; i < elements.length; i++) {
+      var url = elements[i].href || elements[i].src;
+      if (url.indexOf(origin) !== 0) {
+        continue;
+      }
+      url = url.slice(origin.length);
+      if (url.indexOf('combo') === 0) {
+        // Liferay's combo servlet, /combo?browserId=...&/my-portlet/js/main.js&...
+        var parts = url.split('&');
+        for (var j = 1; j < parts.length; j++) {
+          if (parts[j].charAt(0) === '/') {
+            add(parts[j].slice(1));
+          }
+        }
+      } else {
+        add(url);
+      }
+    }
+    return {contexts: contexts};
+  };
+
+  window.LiveReloadPluginHotterDeploy = HotterDeployPlugin;
+})();
@@ -6,21 +6,59 @@ https://launchpad.net/~chris-lea/+archive/python-tornado/
 https://launchpad.net/~chris-lea/+archive/python-pycares
 '''
 
+import time
+import hashlib
 import logging
+from io import BytesIO
+from gzip import GzipFile
+from fnmatch import fnmatch
+from collections import deque
 from datetime import datetime
-from pkg_resources import resource_string
-from tornado.ioloop import IOLoop
+from email.utils import parsedate
+from threading import Thread
+from pkgutil import get_data
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado import escape
 from tornado.web import RequestHandler
 from tornado import web
 from tornado.websocket import WebSocketHandler
 from tornado.util import ObjectDict
 
-from jinja2 import Template
+from .metrics import METRICS
+
+
+# Messages queued for a client before it is considered hung
+MAX_QUEUED_MESSAGES = 16
+# Seconds a single write may take before the client is considered hung
+SLOW_CLIENT_TIMEOUT = 10
+# Seconds between checks for changes of the info page
+STATUS_INTERVAL = 1
+
+
+def resource_string(name):
+    '''
+    A file shipped next to this module, without the startup cost of
+    pkg_resources
+    '''
+    return get_data(__name__, name)
 
 
 class LiveReloadHandler(WebSocketHandler):
+    '''
+    Only touched on the IOLoop, other threads go through broadcast
+    '''
     waiters = set()
+    # [(url glob, portlet names)], pages known to show portlets
+    page_map = []
+
+    def open(self):
+        self._outbox = deque()
+        self._write_started = None
+        # Portlet contexts shown by the page, None when unknown
+        self.contexts = None
+
+    def shows(self, portlet_name):
+        return self.contexts is None or portlet_name in self.contexts
 
     def allow_draft76(self):
         return True
@@ -29,8 +67,8 @@ class LiveReloadHandler(WebSocketHandler):
         return True
 
     def on_close(self):
-        if self in LiveReloadHandler.waiters:
-            LiveReloadHandler.waiters.remove(self)
+        LiveReloadHandler.waiters.discard(self)
+        self._outbox.clear()
 
     def send_message(self, message):
         if isinstance(message, dict):
@@ -40,23 +78,70 @@ class LiveReloadHandler(WebSocketHandler):
         except:
             logging.error('Error sending message', exc_info=True)
 
+    def enqueue(self, message):
+        if (len(self._outbox) >= MAX_QUEUED_MESSAGES or
+                (self._write_started and time.time() - self._write_started > SLOW_CLIENT_TIMEOUT)):
+            self.evict()
+            return
+        self._outbox.append(message)
+        self._flush()
+
+    def evict(self):
+        METRICS.inc('clients_evicted')
+        logging.warn('Dropping slow livereload client %s', getattr(self, 'url', self.request.remote_ip))
+        LiveReloadHandler.waiters.discard(self)
+        self._outbox.clear()
+        self.close()
+
+    def _flush(self):
+        # One write in flight at a time, the rest waits in the outbox
+        while self._outbox and self._write_started is None:
+            try:
+                future = self.write_message(self._outbox.popleft())
+            except Exception:
+                logging.error('Error sending message', exc_info=True)
+                self.evict()
+                return
+            # Done already when it fit in the socket buffer
+            if future is not None and not future.done():
+                self._write_started = time.time()
+                IOLoop.instance().add_future(future, self._on_written)
+
+    def _on_written(self, future):
+        self._write_started = None
+        self._flush()
+
     @staticmethod
-    def reload(path=None):
-        logging.info('Reload %s waiters', len(LiveReloadHandler.waiters))
+    def broadcast(message, portlet_name=None):
+        '''
+        Send a message to every client showing the portlet, or to all
+        clients when no portlet is given. Safe to call from any thread.
+        '''
+        IOLoop.instance().add_callback(LiveReloadHandler._broadcast, message, portlet_name, time.time())
 
+    @staticmethod
+    def _broadcast(message, portlet_name=None, queued=None):
+        if queued is not None:
+            METRICS.observe('broadcast_queued', time.time() - queued)
+        with METRICS.timed('broadcast'):
+            waiters = [waiter for waiter in LiveReloadHandler.waiters
+                       if portlet_name is None or waiter.shows(portlet_name)]
+            logging.info('Reload %s of %s waiters', len(waiters), len(LiveReloadHandler.waiters))
+            for waiter in waiters:
+                waiter.enqueue(message)
+        METRICS.inc('broadcasts')
+        METRICS.inc('messages_sent', len(waiters))
+
+    @staticmethod
+    def reload(path=None, portlet_name=None):
         msg = {
             'command': 'reload',
             'path': path or '*',
             'liveCSS': True,
             'liveImg': True
         }
-        print 'sending', msg
-        for waiter in LiveReloadHandler.waiters:
-            try:
-                waiter.write_message(msg)
-            except:
-                logging.error('Error sending message', exc_info=True)
-                LiveReloadHandler.waiters.remove(waiter)
+        logging.debug('sending %s', msg)
+        LiveReloadHandler.broadcast(msg, portlet_name)
 
     def on_message(self, message):
         """Handshake with livereload.js
@@ -81,46 +166,143 @@ class LiveReloadHandler(WebSocketHandler):
         if message.command == 'info' and 'url' in message:
             # print '- Client connected for url {0}'.format(message.url)
             self.url = message.url
+            self.contexts = self._find_contexts(message)
             LiveReloadHandler.waiters.add(self)
             if hasattr(LiveReloadHandler, 'update_status'):
                 LiveReloadHandler.update_status()
 
 
-class LiveReloadJSHandler(RequestHandler):
+    def _find_contexts(self, message):
+        contexts = set()
+        known = False
+        plugin = (message.get('plugins') or {}).get('hotterdeploy')
+        if plugin and plugin.get('contexts'):
+            contexts.update(plugin['contexts'])
+            known = True
+        for url_pattern, portlet_names in LiveReloadHandler.page_map:
+            if fnmatch(message.url, url_pattern):
+                contexts.update(portlet_names)
+                known = True
+        # Pages we know nothing about get every reload
+        return contexts if known else None
+
+
+class StaticResource(object):
+    '''
+    A packaged file, loaded once together with its validators and its
+    gzipped form
+    '''
+    def __init__(self, data, content_type):
+        self.data = data
+        self.content_type = content_type
+        self.etag = '"{0}"'.format(hashlib.md5(data).hexdigest())
+        # Packaged files do not change while we are running
+        self.last_modified = datetime.utcnow().replace(microsecond=0)
+        buf = BytesIO()
+        with GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+            f.write(data)
+        self.gzipped = buf.getvalue()
+
+
+class StaticResourceHandler(RequestHandler):
+    def initialize(self, resource):
+        self.resource = resource
+
     def get(self):
-        self.set_header('Content-Type', 'application/javascript')
-        self.write(resource_string(__name__, 'livereload.js'))
+        resource = self.resource
+        self.set_header('Etag', resource.etag)
+        self.set_header('Last-Modified', resource.last_modified)
+        # Cheap to revalidate, and a restart may serve a newer version
+        self.set_header('Cache-Control', 'no-cache')
+        if self._not_modified():
+            self.set_status(304)
+            return
+
+        self.set_header('Content-Type', resource.content_type)
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(resource.gzipped)
+        else:
+            self.write(resource.data)
+
+    def _not_modified(self):
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            etags = [etag.strip() for etag in if_none_match.split(',')]
+            return '*' in etags or self.resource.etag in etags
+        if_modified_since = self.request.headers.get('If-Modified-Since')
+        if if_modified_since:
+            parsed = parsedate(if_modified_since)
+            return parsed is not None and datetime(*parsed[:6]) >= self.resource.last_modified
+        return False
+
+
+class MetricsHandler(RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(METRICS.prometheus())
+
+
+class MetricsJSONHandler(RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(escape.json_encode(METRICS.snapshot()))
 
 
 class ForceReloadHandler(RequestHandler):
     def get(self):
-        msg = {
-            'command': 'reload',
-            'path': self.get_argument('path', default=None) or '*',
-            'liveCSS': True,
-            'liveImg': True
-        }
-        for waiter in LiveReloadHandler.waiters:
-            try:
-                waiter.write_message(msg)
-            except:
-                logging.error('Error sending message', exc_info=True)
-                LiveReloadHandler.waiters.remove(waiter)
+        LiveReloadHandler.reload(self.get_argument('path', default=None))
         self.write('ok')
 
 
+class ResyncHandler(RequestHandler):
+    '''
+    /resync?portlet=name, resyncs every portlet when none are given
+    '''
+    @web.asynchronous
+    def get(self):
+        if not hasattr(ResyncHandler, 'hotterDeployer'):
+            self.send_error(503)
+            return
+        # Copying can take a while, keep the IOLoop serving
+        t = Thread(target=self._resync, args=(self.get_arguments('portlet'),))
+        t.daemon = True
+        t.start()
+
+    def _resync(self, portlet_names):
+        try:
+            report = self.hotterDeployer.resync(portlet_names or None)
+        except Exception:
+            logging.error('Resync failed', exc_info=True)
+            IOLoop.instance().add_callback(self.send_error, 500)
+            return
+        IOLoop.instance().add_callback(self._finish, report)
+
+    def _finish(self, report):
+        self.set_header('Content-Type', 'application/json')
+        self.finish(escape.json_encode(report))
+
+
 class LiveReloadInfoHandler(RequestHandler):
+    # Compiled on first use
+    template = None
+
+    @staticmethod
+    def _render_page(now):
+        if LiveReloadInfoHandler.template is None:
+            from jinja2 import Template
+            LiveReloadInfoHandler.template = Template(resource_string('index.html'))
+        return LiveReloadInfoHandler.template.render(
+            ctx=LiveReloadInfoHandler.hotterDeployer,
+            metrics=METRICS.snapshot(),
+            waiters=LiveReloadHandler.waiters,
+            now=now
+            )
+
     def get(self):
         self.set_header('Content-Type', 'text/html')
         if hasattr(LiveReloadInfoHandler, 'hotterDeployer'):
-            tmpl = resource_string(__name__, 'index.html')
-            template = Template(tmpl)
-            data = template.render(
-                ctx=self.hotterDeployer,
-                waiters=LiveReloadHandler.waiters,
-                now=datetime.now()
-                )
-            self.write(data)
+            self.write(self._render_page(datetime.now()))
         else:
             self.write('''
             <html>
@@ -131,8 +313,51 @@ class LiveReloadInfoHandler(RequestHandler):
             ''')
 
 
+class StatusHandler(WebSocketHandler):
+    '''
+    Pushes the info page to the browsers showing it whenever it changed,
+    the page is only rendered while somebody is watching
+    '''
+    watchers = set()
+    _timer = None
+    _digest = None
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self):
+        StatusHandler.watchers.add(self)
+        if StatusHandler._timer is None:
+            StatusHandler._timer = PeriodicCallback(StatusHandler.refresh, STATUS_INTERVAL * 1000)
+            StatusHandler._timer.start()
+
+    def on_close(self):
+        StatusHandler.watchers.discard(self)
+        if not StatusHandler.watchers and StatusHandler._timer is not None:
+            StatusHandler._timer.stop()
+            StatusHandler._timer = None
+            StatusHandler._digest = None
+
+    @staticmethod
+    def refresh():
+        if not hasattr(LiveReloadInfoHandler, 'hotterDeployer'):
+            return
+        # The time on the page changes on every render, leave it out
+        digest = hashlib.md5(LiveReloadInfoHandler._render_page('').encode('utf-8')).hexdigest()
+        if digest == StatusHandler._digest:
+            return
+        StatusHandler._digest = digest
+        page = LiveReloadInfoHandler._render_page(datetime.now())
+        for watcher in list(StatusHandler.watchers):
+            try:
+                watcher.write_message(page)
+            except Exception:
+                logging.debug('Error sending status', exc_info=True)
+                StatusHandler.watchers.discard(watcher)
+
+
 class Server(object):
-    def __init__(self, port=None, host=None, liveport=None):
+    def __init__(self, port=None, host=None, liveport=None, page_map=None):
         self.host = None
         self.port = 35729
         if port:
@@ -140,19 +365,30 @@ class Server(object):
 
         self.host = host or '0.0.0.0'
         self.liveport = liveport
+        LiveReloadHandler.page_map = page_map or []
 
     def application(self, port, host, liveport=None, debug=True):
         if liveport is None:
             liveport = port
 
+        # The plugin reports the portlets shown, it has to come first
+        livereload_js = StaticResource(
+            resource_string('livereload-plugin.js') + resource_string('livereload.js'),
+            'application/javascript'
+        )
+
         live_handlers = [
             (r'/livereload', LiveReloadHandler),
             (r'/forcereload', ForceReloadHandler),
-            (r'/livereload.js', LiveReloadJSHandler),
+            (r'/resync', ResyncHandler),
+            (r'/livereload.js', StaticResourceHandler, {'resource': livereload_js}),
             (r'/info', LiveReloadInfoHandler),
+            (r'/status', StatusHandler),
+            (r'/metrics', MetricsHandler),
+            (r'/metrics.json', MetricsJSONHandler),
         ]
 
-        live = web.Application(handlers=live_handlers, debug=debug)
+        live = web.Application(handlers=live_handlers, debug=debug, compress_response=True)
         live.listen(liveport, address=host)
 
     def serve(self):
@@ -172,8 +408,8 @@ class Server(object):
     def stop(self):
         IOLoop.instance().stop()
 
-    def reload(self, path=None):
-        LiveReloadHandler.reload(path)
+    def reload(self, path=None, portlet_name=None):
+        LiveReloadHandler.reload(path, portlet_name)
 
 
 def main():
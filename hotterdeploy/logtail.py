@@ -0,0 +1,219 @@
+'''
+Shared follower of the tomcat log.
+
+Deploy threads register regex waiters on the tailer of their tomcat and
+block until a matching line shows up. A single thread reads the log for
+all of them, polling with a back-off while nothing is written, and
+starts over from the top when the log was rotated.
+'''
+
+import os
+import re
+import time
+import datetime
+import logging
+from threading import Thread, Condition, Event, Lock
+
+LOG = logging.getLogger(__name__)
+
+MIN_POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 1.0
+CHUNK_SIZE = 64 * 1024
+# Seconds the log is followed after a fallback line ended a wait, looking
+# for the line that was waited for
+CONFIRM_TIME = 60
+
+
+def catalina_log_path(tomcat_directory):
+    if os.name == 'nt':
+        today = datetime.date.today()
+        catalina_log = 'logs/catalina.%s-%02d-%02d.out' % (today.year, today.month, today.day)
+    else:
+        catalina_log = 'logs/catalina.out'
+    return os.path.join(tomcat_directory, catalina_log)
+
+
+class LogWaiter(object):
+    def __init__(self, patterns, fallback_patterns=()):
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        # Lines not naming what is waited for, only trusted when nobody else
+        # is waiting for a line
+        self.fallback_patterns = [re.compile(pattern) for pattern in fallback_patterns]
+        self.match = None
+        # Whether the match came from a fallback pattern
+        self.fallback = False
+        # Lines ending before this offset were written before we started waiting
+        self.start = 0
+        self._event = Event()
+
+    def feed(self, line, alone=True):
+        patterns = self.patterns + self.fallback_patterns if alone else self.patterns
+        for pattern in patterns:
+            match = pattern.search(line)
+            if match:
+                self.match = match
+                self.fallback = pattern not in self.patterns
+                self._event.set()
+                return True
+        return False
+
+    def wait(self, timeout=None):
+        '''
+        Returns whether a matching line was found within the timeout
+        '''
+        return self._event.wait(timeout)
+
+
+class LogTailer(Thread):
+    _tailers = {}
+    _tailers_lock = Lock()
+
+    @classmethod
+    def for_tomcat(cls, tomcat_directory):
+        '''
+        The shared tailer following the log of a tomcat
+        '''
+        key = os.path.abspath(tomcat_directory)
+        with cls._tailers_lock:
+            tailer = cls._tailers.get(key)
+            if tailer is None:
+                tailer = cls._tailers[key] = cls(lambda: catalina_log_path(key))
+                tailer.start()
+            return tailer
+
+    def __init__(self, path_resolver):
+        super(LogTailer, self).__init__(name='LogTailer')
+        self.daemon = True
+        self._resolve_path = path_resolver
+        self._condition = Condition()
+        self._waiters = []
+        self._file = None
+        self._path = None
+        self._inode = None
+        self._position = 0
+        self._partial = ''
+        # Until a line a waiter was waiting for showed up, the log may only
+        # have fallback lines to offer, which need the waiter to be alone.
+        # Callers hold the lock around such waits, see Deploy
+        self.fallback_lock = Lock()
+        self.names_lines = False
+        # (deadline, patterns) of waiters ended by a fallback line
+        self._unconfirmed = []
+
+    def expect(self, patterns, fallback_patterns=()):
+        '''
+        Start waiting for a line matching any of the patterns, only lines
+        written from now on are considered. The fallback patterns only match
+        lines written while no other waiter was waiting.
+        '''
+        waiter = LogWaiter(patterns, fallback_patterns)
+        with self._condition:
+            if self._file is None:
+                self._open(at_end=True)
+            if self._file is not None:
+                waiter.start = os.fstat(self._file.fileno()).st_size
+            self._waiters.append(waiter)
+            self._condition.notify()
+        return waiter
+
+    def cancel(self, waiter):
+        with self._condition:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def run(self):
+        interval = MIN_POLL_INTERVAL
+        while True:
+            with self._condition:
+                now = time.time()
+                self._unconfirmed = [u for u in self._unconfirmed if u[0] > now]
+                while not self._waiters and not self._unconfirmed:
+                    # Nobody is interested, stop following the log
+                    self._close()
+                    self._condition.wait()
+                got_data = self._poll()
+            if got_data:
+                interval = MIN_POLL_INTERVAL
+            else:
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+            time.sleep(interval)
+
+    def _open(self, at_end=False):
+        path = self._resolve_path()
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return
+        if at_end:
+            f.seek(0, 2)
+        self._file = f
+        self._path = path
+        self._inode = os.fstat(f.fileno()).st_ino
+        self._position = f.tell()
+        self._partial = ''
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+
+    def _poll(self):
+        path = self._resolve_path()
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._close()
+            return False
+
+        rotated = (self._file is not None and
+                   (path != self._path or
+                    (st.st_ino and st.st_ino != self._inode) or
+                    st.st_size < self._position))
+        if rotated:
+            LOG.debug('{0} was rotated'.format(path))
+            self._close()
+        if self._file is None:
+            # New log file, everything in it is new
+            self._open()
+            for waiter in self._waiters:
+                waiter.start = 0
+            if self._file is None:
+                return False
+
+        data = self._file.read(CHUNK_SIZE)
+        if not data:
+            return False
+        while data:
+            self._feed(data)
+            data = self._file.read(CHUNK_SIZE)
+        return True
+
+    def _feed(self, data):
+        lines = (self._partial + data).split('\n')
+        # Keep the incomplete last line for the next read
+        self._partial = lines.pop()
+        offset = self._position
+        for line in lines:
+            offset += len(line) + 1
+            self._confirm(line)
+            listening = [waiter for waiter in self._waiters if offset > waiter.start]
+            for waiter in listening:
+                if waiter.feed(line, alone=len(listening) == 1):
+                    self._waiters.remove(waiter)
+                    if not waiter.fallback:
+                        self.names_lines = True
+                    elif not self.names_lines:
+                        self._unconfirmed.append((time.time() + CONFIRM_TIME, waiter.patterns))
+        self._position = offset
+
+    def _confirm(self, line):
+        '''
+        A line a waiter ended by a fallback line was waiting for shows the
+        log names what is waited for, the fallback lines are not needed
+        '''
+        for deadline, patterns in self._unconfirmed:
+            if any(pattern.search(line) for pattern in patterns):
+                LOG.debug('The log names deploys, waiting for them in parallel')
+                self.names_lines = True
+                self._unconfirmed = []
+                return
@@ -0,0 +1,105 @@
+'''
+Timings and counters of the save-to-reload pipeline.
+
+Every stage (dispatch, portlet lookup, hook check, compile, copy,
+broadcast, deploy, ...) records its durations in a histogram. Percentiles
+are taken over the most recent samples, counts and sums cover the whole
+run. Exposed as JSON and in the Prometheus text format by the livereload
+server.
+'''
+
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+# Samples kept per stage for the percentiles
+WINDOW = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+PREFIX = 'hotterdeploy'
+
+
+class Histogram(object):
+    def __init__(self):
+        self.samples = deque(maxlen=WINDOW)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return dict((q, 0.0) for q in QUANTILES)
+        return dict((q, samples[min(int(q * len(samples)), len(samples) - 1)]) for q in QUANTILES)
+
+
+class Metrics(object):
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms = {}
+        self._counters = {}
+        self.started = time.time()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - start)
+
+    def snapshot(self):
+        with self._lock:
+            stages = {}
+            for stage, histogram in self._histograms.items():
+                quantiles = histogram.quantiles()
+                stages[stage] = {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'p50': quantiles[0.5],
+                    'p95': quantiles[0.95],
+                    'p99': quantiles[0.99],
+                }
+            return {
+                'uptime': time.time() - self.started,
+                'stages': stages,
+                'counters': dict(self._counters),
+            }
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP {0}_stage_seconds Duration of the stages of the save-to-reload pipeline'.format(PREFIX),
+            '# TYPE {0}_stage_seconds summary'.format(PREFIX),
+        ]
+        for stage, values in sorted(snapshot['stages'].items()):
+            for q in QUANTILES:
+                lines.append('{0}_stage_seconds{{stage="{1}",quantile="{2}"}} {3!r}'.format(
+                    PREFIX, stage, q, values['p{0}'.format(int(q * 100))]))
+            lines.append('{0}_stage_seconds_sum{{stage="{1}"}} {2!r}'.format(PREFIX, stage, values['sum']))
+            lines.append('{0}_stage_seconds_count{{stage="{1}"}} {2}'.format(PREFIX, stage, values['count']))
+        for counter, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE {0}_{1}_total counter'.format(PREFIX, counter))
+            lines.append('{0}_{1}_total {2}'.format(PREFIX, counter, value))
+        lines.append('# TYPE {0}_uptime_seconds gauge'.format(PREFIX))
+        lines.append('{0}_uptime_seconds {1!r}'.format(PREFIX, snapshot['uptime']))
+        return '\n'.join(lines) + '\n'
+
+
+# Shared by everything in the process
+METRICS = Metrics()
@@ -0,0 +1,217 @@
+'''
+Polling observer for file systems without change notifications
+(vboxfs, NFS, ...).
+
+Each watch keeps a compact (mtime, size) snapshot of its tree, filtered by
+include/exclude globs, and diffs it against a fresh one on every poll.
+The poll interval backs off while nothing changes and drops back to the
+minimum as soon as a change is seen. Subtrees of a recursive watch can be
+stat'ed in parallel on a shared thread pool.
+
+A watch scheduled with a scope (see WorkspaceIndex.watch_roots) only polls
+the roots of that scope instead of its whole tree.
+'''
+
+import os
+import stat
+import logging
+from fnmatch import fnmatch
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from watchdog.observers.api import (
+    EventEmitter,
+    BaseObserver,
+    DEFAULT_EMITTER_TIMEOUT,
+)
+from watchdog.events import (
+    DirDeletedEvent,
+    DirCreatedEvent,
+    FileDeletedEvent,
+    FileCreatedEvent,
+    FileModifiedEvent,
+)
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_EXCLUDES = ['test', '.svn', '.git', 'node_modules', '.settings', '.metadata', '*.java', '*.zip', '*.pptx']
+BACKOFF_FACTOR = 1.5
+
+
+class PollingRules(object):
+    '''
+    Include/exclude globs, matched against file and directory names.
+    Excludes apply to both, includes only to files.
+    '''
+    def __init__(self, includes=None, excludes=None):
+        self.includes = list(includes or [])
+        self.excludes = list(DEFAULT_EXCLUDES if excludes is None else excludes)
+
+    def accepts(self, name, is_directory):
+        if any(fnmatch(name, pattern) for pattern in self.excludes):
+            return False
+        if is_directory or not self.includes:
+            return True
+        return any(fnmatch(name, pattern) for pattern in self.includes)
+
+
+class SnapshotEmitter(EventEmitter):
+    def __init__(self, event_queue, watch, timeout=DEFAULT_EMITTER_TIMEOUT,
+                 rules=None, max_interval=None, pool=None, scope=None):
+        EventEmitter.__init__(self, event_queue, watch, timeout)
+        self._rules = rules or PollingRules()
+        self._scope = scope
+        # path -> whether its whole tree is polled
+        self._roots = {}
+        # Module areas of the scope that did not exist at the last poll
+        self._absent = set()
+        self._min_interval = timeout
+        self._max_interval = max(max_interval or timeout, timeout)
+        self._interval = timeout
+        self._pool = pool
+        # path -> (mtime, size, is directory)
+        self._snapshot = {}
+
+    def on_thread_start(self):
+        if self._scope is None:
+            self._snapshot = self._take_snapshot(self.watch.path, self.watch.is_recursive)
+        else:
+            self._snapshot = self._take_scoped_snapshot(announce=False)[0]
+
+    def queue_events(self, timeout):
+        # timeout is replaced by our own adaptive interval
+        if self.stopped_event.wait(self._interval):
+            return
+
+        previous = self._snapshot
+        if self._scope is None:
+            snapshot = self._take_snapshot(self.watch.path, self.watch.is_recursive)
+        else:
+            snapshot, known = self._take_scoped_snapshot()
+            # Roots that are new to the scope start out silently
+            known.update(previous)
+            previous = known
+        changed = self._queue_diff(previous, snapshot)
+        self._snapshot = snapshot
+
+        if changed:
+            self._interval = self._min_interval
+        else:
+            self._interval = min(self._interval * BACKOFF_FACTOR, self._max_interval)
+
+    def _queue_diff(self, old, new):
+        deleted = [path for path in old if path not in new]
+        created = sorted(path for path in new if path not in old)
+        modified = [path for path, entry in new.items()
+                    if not entry[2] and path in old and old[path] != entry]
+
+        for path in deleted:
+            self.queue_event(DirDeletedEvent(path) if old[path][2] else FileDeletedEvent(path))
+        for path in created:
+            if new[path][2]:
+                self.queue_event(DirCreatedEvent(path))
+            else:
+                # Mimic FS events, where a new file is also written to
+                self.queue_event(FileCreatedEvent(path))
+                self.queue_event(FileModifiedEvent(path))
+        for path in modified:
+            self.queue_event(FileModifiedEvent(path))
+
+        return bool(deleted or created or modified)
+
+    def _take_scoped_snapshot(self, announce=True):
+        '''
+        Snapshot of all roots of the scope, and the part of it taken from
+        module areas new to the scope, like the areas of a module that was
+        just found. Areas that were created since the last poll are not part
+        of the latter, so their content is reported.
+        '''
+        roots = self._scope.watch_roots()
+        recursive_roots = set(root for root, recursive in roots.items() if recursive)
+        appeared = self._absent & recursive_roots if announce else set()
+        self._absent = set(self._scope.areas()) - recursive_roots
+
+        snapshot, known = {}, {}
+        for root, recursive in roots.items():
+            tree = self._take_snapshot(root, recursive)
+            snapshot.update(tree)
+            if recursive and not self._roots.get(root) and root not in appeared:
+                known.update(tree)
+        self._roots = roots
+        return snapshot, known
+
+    def _take_snapshot(self, directory, recursive):
+        snapshot = {}
+        subdirectories = self._scan_directory(directory, snapshot)
+        if not recursive:
+            return snapshot
+
+        if self._pool and len(subdirectories) > 1:
+            for tree in self._pool.map(self._walk, subdirectories):
+                snapshot.update(tree)
+        else:
+            for directory in subdirectories:
+                snapshot.update(self._walk(directory))
+        return snapshot
+
+    def _walk(self, directory):
+        snapshot = {}
+        directories = [directory]
+        while directories:
+            directories.extend(self._scan_directory(directories.pop(), snapshot))
+        return snapshot
+
+    def _scan_directory(self, directory, snapshot):
+        '''
+        Add the accepted entries of a directory to the snapshot, returns
+        its subdirectories
+        '''
+        subdirectories = []
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            # Removed while we were looking
+            return subdirectories
+
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            is_directory = stat.S_ISDIR(st.st_mode)
+            if not self._rules.accepts(name, is_directory):
+                continue
+            snapshot[path] = (st.st_mtime, st.st_size, is_directory)
+            if is_directory:
+                subdirectories.append(path)
+        return subdirectories
+
+
+class SnapshotPollingObserver(BaseObserver):
+    '''
+    File system independent observer that polls the watched trees
+    '''
+    def __init__(self, rules=None, interval=1, max_interval=None, threads=0):
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self._scopes = {}
+        self._snapshot_emitter = partial(SnapshotEmitter,
+                                         rules=rules,
+                                         max_interval=max_interval,
+                                         pool=self.pool)
+        BaseObserver.__init__(self, emitter_class=self._create_emitter, timeout=interval)
+
+    def schedule_scope(self, event_handler, path, scope):
+        '''
+        Watch only the roots of a scope below path
+        '''
+        self._scopes[path] = scope
+        return self.schedule(event_handler, path, recursive=True)
+
+    def _create_emitter(self, event_queue, watch, timeout):
+        return self._snapshot_emitter(event_queue, watch, timeout, scope=self._scopes.get(watch.path))
+
+    def on_thread_stop(self):
+        BaseObserver.on_thread_stop(self)
+        if self.pool:
+            self.pool.terminate()
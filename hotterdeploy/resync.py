@@ -0,0 +1,167 @@
+'''
+Mirrors modules into their latest deployed directory.
+
+Used after events were missed, e.g. after a suspend or when polling fell
+behind. The source trees are walked and every file is compared with its
+deployed copy on a thread pool, only files that differ are copied.
+Stylesheets go through the compiler like a hot-copy would.
+'''
+
+import os
+import time
+import logging
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from .utilities import is_jsp_hook
+from .app_handlers import HOT_COPY_EXTENSIONS
+from . import sassc
+
+LOG = logging.getLogger(__name__)
+
+RESYNC_THREADS = 8
+
+
+def _walk(directory):
+    '''
+    (path, path relative to directory) of every file in a tree
+    '''
+    for root, dirs, files in os.walk(directory):
+        if '.svn' in dirs:
+            dirs.remove('.svn')
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            yield path, os.path.relpath(path, directory)
+
+
+def _sync(file_sync, src, destinations):
+    '''
+    Returns the number of files and bytes copied
+    '''
+    files = size = 0
+    try:
+        for dest in destinations:
+            if file_sync.is_linked(src, dest):
+                # Already has the content, whenever it was saved
+                continue
+            if file_sync.sync_file(src, dest):
+                files += 1
+                size += os.path.getsize(dest)
+    except (IOError, OSError):
+        LOG.warn('Could not copy {0}'.format(src), exc_info=True)
+    return files, size
+
+
+def _run(job):
+    return job()
+
+
+class Resync(object):
+    def __init__(self, hotterDeployer, threads=RESYNC_THREADS):
+        self.hotterDeployer = hotterDeployer
+        self.threads = threads
+
+    def run(self, portlet_names=None):
+        '''
+        Resync the given portlets, or all of them. Returns a report of what
+        was copied.
+        '''
+        start_time = time.time()
+        modules = dict((name, root) for root, name in self.hotterDeployer.portlets.items())
+        report = {
+            'portlets': {},
+            'unknown': [],
+            'not_deployed': [],
+            'files': 0,
+            'bytes': 0,
+        }
+
+        pool = ThreadPool(self.threads)
+        try:
+            for portlet_name in portlet_names or sorted(modules):
+                if portlet_name not in modules:
+                    report['unknown'].append(portlet_name)
+                    continue
+                latest_subdir = self.hotterDeployer.find_latest_temp_dir(portlet_name)
+                if not latest_subdir:
+                    report['not_deployed'].append(portlet_name)
+                    continue
+                files, size = self._resync_module(pool, modules[portlet_name], portlet_name, latest_subdir)
+                report['portlets'][portlet_name] = {'files': files, 'bytes': size}
+                report['files'] += files
+                report['bytes'] += size
+                if files:
+                    self.hotterDeployer.trigger_browser_reload(None, portlet_name)
+        finally:
+            pool.close()
+            pool.join()
+
+        report['seconds'] = round(time.time() - start_time, 3)
+        LOG.info('Resynced {files} file(s), {bytes} bytes in {seconds} seconds'.format(**report))
+        return report
+
+    def _resync_module(self, pool, module_root, portlet_name, latest_subdir):
+        file_sync = self.hotterDeployer.file_sync
+        statics_directory = self.hotterDeployer.statics_directory
+        jobs = []
+        stylesheets = []
+
+        webapp_path = os.path.join(module_root, 'src', 'main', 'webapp')
+        for src, rel_path in _walk(webapp_path):
+            if not rel_path.endswith(HOT_COPY_EXTENSIONS):
+                continue
+            if is_jsp_hook(module_root, rel_path):
+                # Lives in the portal, not in the deployed portlet
+                continue
+            if rel_path.endswith(('.css', '.scss')):
+                if not sassc.is_partial(rel_path):
+                    stylesheets.append((src, rel_path))
+                continue
+            destinations = [os.path.join(latest_subdir, rel_path)]
+            if rel_path.endswith('.js') and statics_directory:
+                destinations.append(os.path.join(statics_directory, portlet_name, rel_path))
+            jobs.append(partial(_sync, file_sync, src, destinations))
+
+        classes_path = os.path.join(module_root, 'target', 'classes')
+        for src, rel_path in _walk(classes_path):
+            dest = os.path.join(latest_subdir, 'WEB-INF', 'classes', rel_path)
+            jobs.append(partial(_sync, file_sync, src, [dest]))
+
+        files = size = 0
+        for copied, copied_size in pool.map(_run, jobs):
+            files += copied
+            size += copied_size
+
+        # The compiler is not shared between threads
+        for src, rel_path in stylesheets:
+            try:
+                copied, copied_size = self._resync_stylesheet(src, rel_path, portlet_name, latest_subdir)
+            except Exception:
+                # Whatever a backend throws, the other stylesheets still get synced
+                LOG.exception('Failed to resync {0}'.format(src))
+                continue
+            files += copied
+            size += copied_size
+
+        LOG.debug('Resynced {0} file(s) of {1}'.format(files, portlet_name))
+        return files, size
+
+    def _resync_stylesheet(self, src, rel_path, portlet_name, latest_subdir):
+        if rel_path.endswith('.scss'):
+            rel_path = rel_path[:-len('.scss')] + '.css'
+        try:
+            data = self.hotterDeployer.sass_cache.compile(src)
+        except (sassc.SassException, IOError, OSError) as e:
+            LOG.warn(e)
+            return 0, 0
+
+        destinations = [os.path.join(latest_subdir, rel_path)]
+        if self.hotterDeployer.statics_directory:
+            destinations.append(os.path.join(self.hotterDeployer.statics_directory, portlet_name, rel_path))
+
+        files = size = 0
+        for dest in destinations:
+            if self.hotterDeployer.file_sync.write_file(data, dest):
+                files += 1
+                size += len(data)
+        return files, size
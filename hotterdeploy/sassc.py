@@ -1,31 +1,362 @@
-#pip install pyScss
+#pip install libsass or pyScss
+
+import os
+import re
+import time
+import hashlib
+import logging
+from pkgutil import find_loader
+from functools import partial
+from collections import OrderedDict
+from multiprocessing import Pool
+from threading import RLock
+
+from .metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+IMPORT_RE = re.compile(r'@import\s+([^;]+);')
+MAX_CACHED_OUTPUTS = 64
 
-from scss.compiler import Compiler, compile_file
-from scss.errors import SassEvaluationError
 
 class SassException(Exception):
     def __init__(self, cause):
-        super(SassException).__init__(cause)
+        super(SassException, self).__init__(cause)
+
+
+def _encode(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    return data
+
+
+class LibSassBackend(object):
+    '''
+    The native libsass compiler, pip install libsass
+    '''
+    name = 'libsass'
+    module = 'sass'
+
+    def __init__(self):
+        import sass
+        self._sass = sass
+
+    def compile(self, file_name):
+        include_paths = [os.path.dirname(os.path.abspath(file_name))]
+        try:
+            if file_name.endswith('.sass'):
+                data = self._sass.compile(filename=file_name, output_style='nested',
+                                          include_paths=include_paths)
+            else:
+                # Liferay themes put scss in .css files, which libsass would
+                # otherwise pass through as plain css
+                with open(file_name, 'rb') as f:
+                    source = f.read().decode('utf-8')
+                data = self._sass.compile(string=source, output_style='nested',
+                                          include_paths=include_paths)
+        except self._sass.CompileError as e:
+            raise SassException(e)
+        return _encode(data)
+
+
+class PyScssBackend(object):
+    '''
+    The pure python compiler, pip install pyScss
+    '''
+    name = 'pyscss'
+    module = 'scss'
 
+    def __init__(self):
+        from scss.compiler import compile_file
+        from scss.errors import SassBaseError
+        self._compile_file = compile_file
+        # Evaluation, syntax and import errors alike
+        self._errors = SassBaseError
+
+    def compile(self, file_name):
+        try:
+            return _encode(self._compile_file(file_name))
+        except self._errors as e:
+            raise SassException(e)
+
+
+# In order of preference
+BACKENDS = OrderedDict([
+    (LibSassBackend.name, LibSassBackend),
+    (PyScssBackend.name, PyScssBackend),
+])
+
+_backend_name = 'auto'
+_backend = None
+
+
+def load_backend(name='auto'):
+    '''
+    Instantiate a backend by name, auto picks the first one installed
+    '''
+    if name != 'auto':
+        try:
+            return BACKENDS[name]()
+        except ImportError as e:
+            raise ImportError('The {0} backend is not available: {1}'.format(name, e))
+    for backend_class in BACKENDS.values():
+        try:
+            return backend_class()
+        except ImportError:
+            continue
+    raise ImportError('No sass compiler installed, pip install libsass or pyScss')
+
+
+def use_backend(name):
+    '''
+    Select the backend used by compile, checking that it is installed
+    without paying for the import until the first compile
+    '''
+    global _backend_name, _backend
+    candidates = BACKENDS.values() if name == 'auto' else [BACKENDS[name]]
+    if not any(find_loader(backend_class.module) for backend_class in candidates):
+        if name == 'auto':
+            raise ImportError('No sass compiler installed, pip install libsass or pyScss')
+        raise ImportError('The {0} backend is not available'.format(name))
+    _backend_name = name
+    _backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = load_backend(_backend_name)
+        LOG.debug('Compiling stylesheets with {0}'.format(_backend.name))
+    return _backend
 
 
 def compile(file_name):
-    #data = Compiler().compile_string("a { color: red + green; }")
+    return get_backend().compile(file_name)
+
+
+def is_partial(file_name):
+    return os.path.basename(file_name).startswith('_')
+
+
+def parse_imports(data):
+    '''
+    The names imported by a stylesheet, plain css imports excluded
+    '''
+    names = []
+    for match in IMPORT_RE.finditer(data):
+        for name in match.group(1).split(','):
+            name = name.strip()
+            if name.startswith('url(') or name.startswith('http'):
+                continue
+            names.append(name.strip('"\''))
+    return names
+
+
+def resolve_import(name, search_path):
+    '''
+    Find the file behind an import, partials and implicit extensions included
+    '''
+    directory, base_name = os.path.split(name)
+    candidates = [base_name]
+    if not os.path.splitext(base_name)[1]:
+        candidates = [base_name + ext for ext in ('.scss', '.sass', '.css')]
+    candidates += ['_' + candidate for candidate in candidates]
+    for path in search_path:
+        for candidate in candidates:
+            file_name = os.path.join(path, directory, candidate)
+            if os.path.isfile(file_name):
+                return os.path.abspath(file_name)
+    return None
+
+
+def find_stylesheets(directory):
+    '''
+    All stylesheets in a tree that are no partials
+    '''
+    for root, dirs, files in os.walk(directory):
+        for file_name in files:
+            if file_name.endswith(('.css', '.scss')) and not is_partial(file_name):
+                yield os.path.join(root, file_name)
+
+
+class SassCache(object):
+    '''
+    Compiled stylesheets keyed by the content hashes of their whole import
+    graph, so unchanged inputs never hit the compiler. Also remembers which
+    entry files import which files, so a changed partial can be traced back
+    to the stylesheets that need recompiling.
+    '''
+    def __init__(self):
+        self._lock = RLock()
+        # path -> [mtime, size, md5, imported names]
+        self._files = {}
+        # entry file -> all files it depends on, itself included
+        self._graphs = {}
+        # md5 of a whole graph -> compiled output
+        self._outputs = OrderedDict()
+
+    def _fingerprint(self, path):
+        st = os.stat(path)
+        cached = self._files.get(path)
+        if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            return cached
+        with open(path, 'rb') as f:
+            data = f.read()
+        cached = [st.st_mtime, st.st_size, hashlib.md5(data).hexdigest(), parse_imports(data)]
+        self._files[path] = cached
+        return cached
+
+    def _graph(self, file_name):
+        graph = OrderedDict()
+        todo = [file_name]
+        while todo:
+            path = todo.pop()
+            if path in graph:
+                continue
+            fingerprint = self._fingerprint(path)
+            graph[path] = fingerprint[2]
+            search_path = [os.path.dirname(path), os.path.dirname(file_name)]
+            for name in fingerprint[3]:
+                imported = resolve_import(name, search_path)
+                if imported:
+                    todo.append(imported)
+        return graph
+
+    def digest(self, file_name):
+        '''
+        Content hash of a stylesheet together with everything it imports
+        '''
+        file_name = os.path.abspath(file_name)
+        with self._lock:
+            graph = self._graph(file_name)
+            self._graphs[file_name] = set(graph)
+        return hashlib.md5(repr(sorted(graph.items()))).hexdigest()
+
+    def lookup(self, digest):
+        with self._lock:
+            return self._outputs.get(digest)
+
+    def store(self, digest, output):
+        with self._lock:
+            self._outputs[digest] = output
+            while len(self._outputs) > MAX_CACHED_OUTPUTS:
+                self._outputs.popitem(last=False)
+
+    def compile(self, file_name):
+        digest = self.digest(file_name)
+        output = self.lookup(digest)
+        if output is None:
+            output = compile(file_name)
+            self.store(digest, output)
+        return output
+
+    def dependents(self, file_name):
+        '''
+        Known entry files importing a file, directly or indirectly
+        '''
+        file_name = os.path.abspath(file_name)
+        with self._lock:
+            return [entry for entry, graph in self._graphs.items()
+                    if entry != file_name and file_name in graph]
+
+    def register(self, file_name):
+        '''
+        Record the import graph of an entry file without compiling it
+        '''
+        self.digest(file_name)
+
+
+def _compile_job(file_name):
+    '''
+    Runs in a worker process, errors are handed back as text
+    '''
     try:
-        data = compile_file(file_name)
-        return data
-    except SassEvaluationError as e:
-        raise SassException(e)
+        return compile(file_name), None
+    except Exception as e:
+        return None, '{0}: {1}'.format(file_name, e)
+
+
+class CompilerPool(object):
+    '''
+    Compiles stylesheets in worker processes, pyScss being CPU bound.
+
+    At most one compile per file is in flight, a newer request for the same
+    file waits for it and replaces any older waiting request. The result of
+    a compile that was superseded in the meantime is dropped, unless the
+    newer request turned out to have the same inputs.
+    '''
+    def __init__(self, processes=2):
+        self.processes = processes
+        self._pool = None
+        self._lock = RLock()
+        # file -> digest being compiled
+        self._in_flight = {}
+        # file -> (digest, callback) waiting for the file's compile in flight
+        self._waiting = {}
+
+    def start(self):
+        # Fork before any other threads are running
+        if self._pool is None:
+            self._pool = Pool(self.processes)
 
+    def stop(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
 
+    def submit(self, file_name, digest, callback):
+        '''
+        Compile a file, callback is called with the output unless a newer
+        request for the same file superseded this one
+        '''
+        with self._lock:
+            if file_name in self._in_flight:
+                if file_name in self._waiting:
+                    LOG.debug('Dropping stale compile of {0}'.format(file_name))
+                self._waiting[file_name] = (digest, callback)
+            else:
+                self._start(file_name, digest, callback)
 
-'''
-import sass
+    def _start(self, file_name, digest, callback):
+        self.start()
+        # Results are handled under the lock, after the file is marked in flight
+        self._pool.apply_async(_compile_job, (file_name,),
+                               callback=partial(self._done, file_name, digest, callback, time.time()))
+        self._in_flight[file_name] = digest
 
+    def _done(self, file_name, digest, callback, started, result):
+        '''
+        Runs on the result handler thread of the pool, which stops handing
+        out results for good when anything raises here
+        '''
+        try:
+            METRICS.observe('scss_compile', time.time() - started)
+        finally:
+            with self._lock:
+                del self._in_flight[file_name]
+                waiting = self._waiting.pop(file_name, None)
+                stale = waiting and waiting[0] != digest
+                if stale:
+                    LOG.debug('Dropping stale compile of {0}'.format(file_name))
+                    METRICS.inc('scss_stale_compiles')
+                    try:
+                        self._start(file_name, *waiting)
+                    except Exception:
+                        LOG.exception('Could not compile {0}'.format(file_name))
+        if stale:
+            return
 
-print '-----------'
-data = sass.compile(filename=event.src_path,
-                    output_style='nested',
-                    include_paths=os.path.dirname(event.src_path))
-print '-----------'
-'''
+        output, error = result
+        if error:
+            METRICS.inc('scss_errors')
+            LOG.warn(error)
+            return
+        callbacks = [callback]
+        if waiting:
+            # Same inputs, no need to compile again
+            callbacks.append(waiting[1])
+        for done in callbacks:
+            try:
+                done(output)
+            except Exception:
+                LOG.exception('Failed to handle the compiled {0}'.format(file_name))
@@ -0,0 +1,212 @@
+'''
+Writes into the deployed directories.
+
+Destinations that already have the content are left alone, so tomcat does
+not recompile jsps that did not change. Everything else is written to a
+temporary file next to the destination and renamed into place, so tomcat
+and the browser never read a half written file. Files can also be hard
+linked or reflinked (copy-on-write clones on btrfs/xfs) instead of copied,
+falling back to a copy when source and destination are on different file
+systems.
+'''
+
+import os
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+from functools import wraps
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+COPY = 'copy'
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+LINK_MODES = [COPY, HARDLINK, REFLINK]
+
+# linux/fs.h _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+CHUNK_SIZE = 1024 * 1024
+# copystat loses the sub-microsecond part of float mtimes
+MTIME_TOLERANCE = 1e-5
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _linked(src_st, dest_st):
+    return bool(src_st.st_ino) and src_st.st_ino == dest_st.st_ino and src_st.st_dev == dest_st.st_dev
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _temp_path(dest):
+    directory, name = os.path.split(dest)
+    _makedirs(directory)
+    fd, temp_path = tempfile.mkstemp(prefix='.' + name + '.', suffix='.tmp', dir=directory)
+    os.close(fd)
+    return temp_path
+
+
+def _replace(temp_path, dest):
+    try:
+        if os.name == 'nt' and os.path.exists(dest):
+            # No atomic replace on windows
+            os.remove(dest)
+        os.rename(temp_path, dest)
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+
+def _timed_copy(method):
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        with METRICS.timed('copy'):
+            written = method(*args, **kwargs)
+        METRICS.inc('files_copied' if written else 'files_unchanged')
+        return written
+    return wrapper
+
+
+class FileSync(object):
+    def __init__(self, link_mode=COPY, verify_hash=False):
+        if link_mode not in LINK_MODES:
+            raise ValueError('Unknown link mode {0}'.format(link_mode))
+        self.link_mode = link_mode
+        self.verify_hash = verify_hash
+        # dest -> mtime of its source when last synced, for hard linked files
+        self._linked_mtimes = {}
+
+    def is_linked(self, src, dest):
+        '''
+        Whether dest is a hard link to src
+        '''
+        try:
+            return _linked(os.stat(src), os.stat(dest))
+        except OSError:
+            return False
+
+    def is_unchanged(self, src, dest):
+        '''
+        Whether dest already has the content of src
+        '''
+        try:
+            src_st = os.stat(src)
+            dest_st = os.stat(dest)
+        except OSError:
+            return False
+        if _linked(src_st, dest_st):
+            return True
+        if src_st.st_size != dest_st.st_size:
+            return False
+        # We copied the mtime along with the content
+        if abs(src_st.st_mtime - dest_st.st_mtime) < MTIME_TOLERANCE:
+            return True
+        # Same size but touched, e.g. rebuilt by maven or saved again
+        return self.verify_hash and file_md5(src) == file_md5(dest)
+
+    @_timed_copy
+    def sync_file(self, src, dest):
+        '''
+        Make dest a copy of src, returns whether dest changed: whether
+        anything was written, or for a hard linked file whether src was
+        saved in place since the last sync
+        '''
+        if self.is_linked(src, dest):
+            # dest changed along with src, only the reload is left to do
+            mtime = os.stat(src).st_mtime
+            previous = self._linked_mtimes.get(dest)
+            self._linked_mtimes[dest] = mtime
+            return previous != mtime
+
+        if self.is_unchanged(src, dest):
+            LOG.debug('{0} is unchanged'.format(dest))
+            return False
+
+        if self.link_mode == HARDLINK and self._link(src, dest):
+            self._linked_mtimes[dest] = os.stat(src).st_mtime
+            METRICS.inc('files_linked')
+            return True
+
+        temp_path = _temp_path(dest)
+        try:
+            if not (self.link_mode == REFLINK and self._reflink(src, temp_path)):
+                shutil.copyfile(src, temp_path)
+            shutil.copystat(src, temp_path)
+        except (IOError, OSError):
+            os.remove(temp_path)
+            raise
+        _replace(temp_path, dest)
+        METRICS.inc('bytes_copied', os.path.getsize(dest))
+        return True
+
+    @_timed_copy
+    def write_file(self, data, dest):
+        '''
+        Make dest contain data, returns whether anything was written
+        '''
+        try:
+            if os.path.getsize(dest) == len(data):
+                with open(dest, 'rb') as f:
+                    if f.read() == data:
+                        LOG.debug('{0} is unchanged'.format(dest))
+                        return False
+        except (IOError, OSError):
+            pass
+
+        temp_path = _temp_path(dest)
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+        except (IOError, OSError):
+            os.remove(temp_path)
+            raise
+        _replace(temp_path, dest)
+        METRICS.inc('bytes_copied', len(data))
+        return True
+
+    def _link(self, src, dest):
+        if not hasattr(os, 'link'):
+            return False
+        temp_path = _temp_path(dest)
+        os.remove(temp_path)
+        try:
+            os.link(src, temp_path)
+        except OSError:
+            # Most likely another file system
+            LOG.debug('Could not link {0}, copying instead'.format(src), exc_info=True)
+            return False
+        _replace(temp_path, dest)
+        return True
+
+    def _reflink(self, src, temp_path):
+        if fcntl is None:
+            return False
+        try:
+            with open(src, 'rb') as s:
+                with open(temp_path, 'wb') as d:
+                    fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except (IOError, OSError):
+            LOG.debug('Could not reflink {0}, copying instead'.format(src), exc_info=True)
+            return False
+        return True
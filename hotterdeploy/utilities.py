@@ -1,6 +1,7 @@
 import os
 import sys
 from xml.dom import minidom
+from xml.parsers.expat import ExpatError
 
 
 def getElementsByTagName(xmldoc, name, parent_name='project'):
@@ -12,14 +13,46 @@ def getElementsByTagName(xmldoc, name, parent_name='project'):
     return els
 
 
-def is_jsp_hook(cwd, rel_path):
+# module root -> custom-jsp-dir of its liferay-hook.xml, None when there is none
+_custom_jsp_dirs = {}
+
+
+def get_custom_jsp_dir(cwd):
+    '''
+    The custom-jsp-dir of a module, cached until invalidate_hook_cache
+    '''
+    if cwd not in _custom_jsp_dirs:
+        _custom_jsp_dirs[cwd] = _read_custom_jsp_dir(cwd)
+    return _custom_jsp_dirs[cwd]
+
+
+def _read_custom_jsp_dir(cwd):
     liferay_hook_path = os.path.join(cwd, 'src/main/webapp/WEB-INF/liferay-hook.xml')
-    if os.path.exists(liferay_hook_path):
+    if not os.path.exists(liferay_hook_path):
+        return None
+    try:
         xmldoc = minidom.parse(liferay_hook_path)
-        custom_jsp_dir = getElementsByTagName(xmldoc, 'custom-jsp-dir', 'hook')[0].firstChild.nodeValue
-        if rel_path.startswith(custom_jsp_dir[1:]+'/'):
-            rel_path = rel_path.split(custom_jsp_dir[1:]+'/')[1]
-            return rel_path
+    except ExpatError:
+        # Probably still being written, we'll be invalidated when it is
+        return None
+    els = getElementsByTagName(xmldoc, 'custom-jsp-dir', 'hook')
+    if not els or not els[0].firstChild:
+        # A hook without jsps
+        return None
+    return els[0].firstChild.nodeValue.strip().strip('/')
+
+
+def invalidate_hook_cache(cwd=None):
+    if cwd is None:
+        _custom_jsp_dirs.clear()
+    else:
+        _custom_jsp_dirs.pop(cwd, None)
+
+
+def is_jsp_hook(cwd, rel_path):
+    custom_jsp_dir = get_custom_jsp_dir(cwd)
+    if custom_jsp_dir and rel_path.startswith(custom_jsp_dir+'/'):
+        return rel_path[len(custom_jsp_dir)+1:]
 
 
 def filter_filename(file_name, patterns=[]):
@@ -29,9 +62,13 @@ def filter_filename(file_name, patterns=[]):
     return False
 
 
-def scan_working_directory_for_portlet_contexts(directory):
-    portlets = {}
+IGNORED_DIRECTORIES = ['.svn', '.git', 'node_modules', 'target', '.metadata', '.settings', 'src', 'Servers']
+
 
+def get_portlet_name(pom_path):
+    '''
+    Derive the deployed portlet name from a pom.xml, the war name
+    '''
     def get_version(xmldoc):
         els = getElementsByTagName(xmldoc, 'version')
         if len(els):
@@ -40,56 +77,71 @@ def scan_working_directory_for_portlet_contexts(directory):
         els = els[0].getElementsByTagName('version')
         return els[0].firstChild.nodeValue
 
+    xmldoc = minidom.parse(pom_path)
+    portlet_name = getElementsByTagName(xmldoc, 'artifactId')[0].firstChild.nodeValue
+    if not any(map(lambda x: portlet_name.endswith('-'+x), ['portlet', 'hook', 'theme', 'web', 'layouttpl'])):
+        portlet_name += '-'+get_version(xmldoc)
+    # TODO: fetch the war name if its specified in the build config
+    return portlet_name
+
+
+def scan_working_directory_for_portlet_contexts(directory):
+    portlets = {}
+
     for file_name in os.listdir(directory):
         path = os.path.join(directory, file_name)
         if (os.path.isdir(path)
-            and not filter_filename(file_name, ['.svn',
-                                                'target',
-                                                '.metadata',
-                                                '.settings',
-                                                'src',
-                                                'Servers'])):
+            and not filter_filename(file_name, IGNORED_DIRECTORIES)):
             portlets.update(scan_working_directory_for_portlet_contexts(path))
         else:
             # Deployed portlet name is derived from the war name
             if file_name == 'pom.xml':
-                xmldoc = minidom.parse(path)
-                portlet_name = getElementsByTagName(xmldoc, 'artifactId')[0].firstChild.nodeValue
-                if not any(map(lambda x: portlet_name.endswith('-'+x), ['portlet', 'hook', 'theme', 'web', 'layouttpl'])):
-                    portlet_name += '-'+get_version(xmldoc)
-                # TODO: fetch the war name if its specified in the build config
                 webapp_path = os.path.abspath(directory)
-                portlets[webapp_path] = portlet_name
+                portlets[webapp_path] = get_portlet_name(path)
 
     return portlets
 
 
-def scan_tomcat_temporary_directory(directory):
+def scan_tomcat_temporary_directory(directory, subdirectories=None):
+    '''
+    Optionally takes an already known listing of the subdirectories
+    '''
     deploys = {}
+    if subdirectories is None:
+        subdirectories = [d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))]
     # Collect the temp deploy dirs for all portlets
-    for deploy in os.listdir(directory):
+    for deploy in subdirectories:
         portlet_name = deploy.split('-', 1)
         deploy_path = os.path.join(directory, deploy)
-        if os.path.isdir(deploy_path) and len(portlet_name) > 1:
+        if len(portlet_name) > 1:
             portlet_name = portlet_name[1]
             if portlet_name not in deploys:
                 deploys[portlet_name] = []
             deploys[portlet_name].append(deploy_path)
 
     # Now only save the latest temp deploy dir per portlet
+    latest = {}
     for portlet_name, deploy_paths in deploys.items():
-        deploys[portlet_name] = max(deploy_paths, key=os.path.getmtime)
+        mtimes = []
+        for deploy_path in deploy_paths:
+            try:
+                mtimes.append((os.path.getmtime(deploy_path), deploy_path))
+            except OSError:
+                # Removed by Liferay in the meantime
+                continue
+        if mtimes:
+            latest[portlet_name] = max(mtimes)[1]
 
-    return deploys
+    return latest
 
 
-def scan_tomcat_webapps_directory(directory):
+def scan_tomcat_webapps_directory(directory, subdirectories=None):
     deploys = {}
+    if subdirectories is None:
+        subdirectories = [d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))]
     # Collect the temp deploy dirs for all portlets
-    for deploy in os.listdir(directory):
-        deploy_path = os.path.join(directory, deploy)
-        if os.path.isdir(deploy_path):
-            deploys[deploy] = deploy_path
+    for deploy in subdirectories:
+        deploys[deploy] = os.path.join(directory, deploy)
 
     return deploys
 
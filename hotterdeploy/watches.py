@@ -0,0 +1,301 @@
+'''
+Scoped watches on the workspace.
+
+Only the roots handed out by a scope (see WorkspaceIndex.watch_roots) are
+watched: directories of the scanned tree on their own, module areas with
+their whole tree. The roots are brought up to date whenever the version of
+the scope changes, or a directory appears or disappears next to them.
+
+watchdog runs an inotify instance and a thread per watch, and the number
+of inotify instances per user is limited (fs.inotify.max_user_instances,
+128 by default). All roots of a scope therefore share a single inotify
+instance, read by a single emitter.
+'''
+
+import os
+import errno
+import ctypes
+import select
+import logging
+
+from watchdog.observers.api import (
+    EventEmitter,
+    BaseObserver,
+    DEFAULT_EMITTER_TIMEOUT,
+    DEFAULT_OBSERVER_TIMEOUT,
+)
+from watchdog.observers.inotify import InotifyEmitter
+from watchdog.observers.inotify_c import (
+    Inotify,
+    InotifyConstants,
+    WATCHDOG_ALL_EVENTS,
+    inotify_init,
+    inotify_add_watch,
+    inotify_rm_watch,
+)
+from watchdog.events import (
+    DirDeletedEvent,
+    DirCreatedEvent,
+    DirModifiedEvent,
+    DirMovedEvent,
+    FileDeletedEvent,
+    FileCreatedEvent,
+    FileModifiedEvent,
+    FileMovedEvent,
+    generate_sub_moved_events,
+)
+from watchdog.utils import unicode_paths
+
+LOG = logging.getLogger(__name__)
+
+EVENT_BUFFER_SIZE = 64 * 1024
+
+
+def _in_tree(path, directory):
+    return path == directory or path.startswith(directory + os.sep)
+
+
+class ScopedInotifyEmitter(EventEmitter):
+    '''
+    Watches the roots of a scope with a single inotify instance.
+
+    A move is reported as such when both of its halves are read at once,
+    otherwise as a delete or create.
+    '''
+    def __init__(self, event_queue, watch, timeout=DEFAULT_EMITTER_TIMEOUT, scope=None):
+        EventEmitter.__init__(self, event_queue, watch, timeout)
+        self._scope = scope
+        self._fd = None
+        self._version = None
+        # path -> whether its whole tree is watched
+        self._roots = {}
+        # Module areas that did not exist at the last update
+        self._absent = set()
+        self._wd_for_path = {}
+        self._path_for_wd = {}
+        self._warned = False
+
+    def on_thread_start(self):
+        self._fd = inotify_init()
+        if self._fd == -1:
+            LOG.warn('Could not watch {0}, changes will not be copied: {1}'.format(
+                self.watch.path, os.strerror(ctypes.get_errno())))
+            self.stopped_event.set()
+            return
+        self._update(announce=False)
+
+    def run(self):
+        if self._fd == -1:
+            return
+        try:
+            EventEmitter.run(self)
+        finally:
+            os.close(self._fd)
+
+    def queue_events(self, timeout):
+        if self._scope.version != self._version:
+            self._update()
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return
+        try:
+            data = os.read(self._fd, EVENT_BUFFER_SIZE)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return
+            raise
+
+        events = list(Inotify._parse_event_buffer(data))
+        moved_from = dict((cookie, (wd, name)) for wd, mask, cookie, name in events
+                          if mask & InotifyConstants.IN_MOVED_FROM)
+        moved_to = set(cookie for wd, mask, cookie, name in events
+                       if mask & InotifyConstants.IN_MOVED_TO)
+        roots_changed = False
+        for wd, mask, cookie, name in events:
+            if wd == -1:
+                if mask & InotifyConstants.IN_Q_OVERFLOW:
+                    LOG.warn('Too many changes at once, some of them were missed')
+                continue
+            directory = self._path_for_wd.get(wd)
+            if directory is None:
+                # Unwatched in the meantime
+                continue
+            if mask & InotifyConstants.IN_IGNORED:
+                self._forget(wd)
+                continue
+            path = os.path.join(directory, name) if name else directory
+            is_directory = bool(mask & InotifyConstants.IN_ISDIR)
+            if is_directory and not self._recursive(directory):
+                # Possibly a module area appearing or disappearing
+                roots_changed = True
+
+            if mask & InotifyConstants.IN_MOVED_FROM:
+                if cookie not in moved_to:
+                    self._deleted(path, is_directory)
+            elif mask & InotifyConstants.IN_MOVED_TO:
+                source = moved_from.get(cookie)
+                src_directory = source and self._path_for_wd.get(source[0])
+                if src_directory:
+                    self._moved(os.path.join(src_directory, source[1]), path, is_directory)
+                else:
+                    self._created(path, is_directory)
+            elif mask & InotifyConstants.IN_CREATE:
+                self._created(path, is_directory)
+            elif mask & (InotifyConstants.IN_MODIFY | InotifyConstants.IN_ATTRIB):
+                self.queue_event(DirModifiedEvent(path) if is_directory else FileModifiedEvent(path))
+            elif mask & InotifyConstants.IN_DELETE:
+                self._deleted(path, is_directory)
+            elif mask & InotifyConstants.IN_DELETE_SELF and path in self._roots:
+                self.queue_event(DirDeletedEvent(path))
+                roots_changed = True
+
+        if roots_changed:
+            self._update()
+
+    def _created(self, path, is_directory):
+        if not is_directory:
+            self.queue_event(FileCreatedEvent(path))
+            return
+        self.queue_event(DirCreatedEvent(path))
+        if self._recursive(path):
+            # Whatever was written before the watch was added
+            self._watch_tree(path, announce=True)
+
+    def _deleted(self, path, is_directory):
+        if not is_directory:
+            self.queue_event(FileDeletedEvent(path))
+            return
+        self.queue_event(DirDeletedEvent(path))
+        # Watches of a tree moved out of sight would report the old paths
+        for watched in list(self._wd_for_path):
+            if _in_tree(watched, path):
+                self._remove_watch(watched)
+
+    def _moved(self, src_path, dest_path, is_directory):
+        if not is_directory:
+            self.queue_event(FileMovedEvent(src_path, dest_path))
+            return
+        self.queue_event(DirMovedEvent(src_path, dest_path))
+        for path in list(self._wd_for_path):
+            if _in_tree(path, src_path):
+                wd = self._wd_for_path.pop(path)
+                moved_path = dest_path + path[len(src_path):]
+                self._wd_for_path[moved_path] = wd
+                self._path_for_wd[wd] = moved_path
+        if self._recursive(dest_path):
+            for event in generate_sub_moved_events(src_path, dest_path):
+                self.queue_event(event)
+            self._watch_tree(dest_path)
+
+    def _recursive(self, path):
+        '''
+        Whether a directory is in the tree of a recursive root
+        '''
+        while True:
+            if self._roots.get(path):
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+    def _update(self, announce=True):
+        '''
+        Bring the watches in line with the roots of the scope, announcing
+        the content of module areas that just appeared and of directories
+        new to the scanned tree
+        '''
+        self._version = self._scope.version
+        roots = self._scope.watch_roots()
+        recursive_roots = set(root for root, recursive in roots.items() if recursive)
+        appeared = self._absent & recursive_roots if announce else set()
+        self._absent = set(self._scope.areas()) - recursive_roots
+
+        previous, self._roots = self._roots, roots
+        for path in list(self._wd_for_path):
+            if path not in roots and not self._recursive(path):
+                self._remove_watch(path)
+
+        for root, recursive in roots.items():
+            if previous.get(root) == recursive and root in self._wd_for_path:
+                continue
+            if recursive:
+                self._watch_tree(root, announce=root in appeared)
+            else:
+                self._add_watch(root)
+                if announce and root not in previous:
+                    # A pom.xml may have been written before the watch was added
+                    self._announce_entries(root)
+        LOG.debug('Watching {0} directories for {1} roots'.format(len(self._wd_for_path), len(roots)))
+
+    def _watch_tree(self, root, announce=False):
+        self._add_watch(root)
+        for directory, dirnames, filenames in os.walk(root):
+            for name in dirnames:
+                path = os.path.join(directory, name)
+                if not os.path.islink(path):
+                    self._add_watch(path)
+                if announce:
+                    self.queue_event(DirCreatedEvent(path))
+            if announce:
+                for name in filenames:
+                    path = os.path.join(directory, name)
+                    # Mimic the events of a file being created and written
+                    self.queue_event(FileCreatedEvent(path))
+                    self.queue_event(FileModifiedEvent(path))
+
+    def _announce_entries(self, directory):
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                self.queue_event(DirCreatedEvent(path))
+            else:
+                self.queue_event(FileCreatedEvent(path))
+
+    def _add_watch(self, path):
+        wd = inotify_add_watch(self._fd, unicode_paths.encode(path), WATCHDOG_ALL_EVENTS)
+        if wd == -1:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC and not self._warned:
+                self._warned = True
+                LOG.warn('Reached the inotify watch limit (fs.inotify.max_user_watches), '
+                         'changes below {0} and others will be missed'.format(path))
+            elif err != errno.ENOENT:
+                LOG.debug('Could not watch {0}: {1}'.format(path, os.strerror(err)))
+            return
+        self._wd_for_path[path] = wd
+        self._path_for_wd[wd] = path
+
+    def _remove_watch(self, path):
+        wd = self._wd_for_path.pop(path)
+        del self._path_for_wd[wd]
+        # Fails for directories that are already gone, nothing to clean up then
+        inotify_rm_watch(self._fd, wd)
+
+    def _forget(self, wd):
+        path = self._path_for_wd.pop(wd)
+        if self._wd_for_path.get(path) == wd:
+            del self._wd_for_path[path]
+
+
+class ScopedInotifyObserver(BaseObserver):
+    '''
+    Inotify observer that watches the roots of a scope through a single
+    watch, other watches are regular inotify watches
+    '''
+    def __init__(self, timeout=DEFAULT_OBSERVER_TIMEOUT):
+        self._scopes = {}
+        BaseObserver.__init__(self, emitter_class=self._create_emitter, timeout=timeout)
+
+    def schedule_scope(self, event_handler, path, scope):
+        self._scopes[path] = scope
+        return self.schedule(event_handler, path, recursive=True)
+
+    def _create_emitter(self, event_queue, watch, timeout):
+        scope = self._scopes.get(watch.path)
+        if scope is None:
+            return InotifyEmitter(event_queue, watch, timeout)
+        return ScopedInotifyEmitter(event_queue, watch, timeout, scope)
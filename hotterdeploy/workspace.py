@@ -0,0 +1,288 @@
+'''
+Incrementally maintained index of the portlet modules in a workspace.
+
+The index maps module roots (the directories holding a pom.xml) to the
+deployed portlet name. After the initial scan only the module whose pom.xml
+changed is re-parsed, and deleted modules are dropped from the index.
+
+The walk state (directory mtimes and listings, pom.xml mtimes and sizes)
+can be dumped and handed back on the next start, in which case only the
+directories and pom.xml files whose stat changed are read again.
+
+Paths of file events are resolved to their module, the area of the module
+they are in and their path relative to that area by a path component trie
+over the module roots, rebuilt whenever the modules change.
+'''
+
+import os
+import logging
+from collections import namedtuple
+from threading import RLock
+
+from .utilities import (
+    IGNORED_DIRECTORIES,
+    filter_filename,
+    get_portlet_name,
+)
+
+LOG = logging.getLogger(__name__)
+
+# The areas of a module we copy from
+WEBAPP_AREA = os.path.join('src', 'main', 'webapp')
+CLASSES_AREA = os.path.join('target', 'classes')
+AREAS = [WEBAPP_AREA, CLASSES_AREA]
+
+# Key of the module stored in a trie node, never a path component
+_MODULE = None
+
+Location = namedtuple('Location', ['module_root', 'portlet_name', 'area', 'rel_path'])
+
+
+def _in_tree(path, directory):
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def _pop_tree(mapping, directory):
+    popped = {}
+    for path in list(mapping.keys()):
+        if _in_tree(path, directory):
+            popped[path] = mapping.pop(path)
+    return popped
+
+
+def _components(path):
+    return os.path.abspath(path).split(os.sep)
+
+
+class PathIndex(object):
+    '''
+    Resolves paths to a Location: the innermost module containing them,
+    the area of that module (None when outside of the areas) and the path
+    relative to the area.
+    '''
+    def __init__(self, portlets):
+        self._root = {}
+        for module_root, portlet_name in portlets.items():
+            node = self._root
+            for part in _components(module_root):
+                node = node.setdefault(part, {})
+            node[_MODULE] = (module_root, portlet_name)
+        self._areas = [(area, area.split(os.sep)) for area in AREAS]
+
+    def classify(self, path):
+        parts = _components(path)
+        node = self._root
+        module, depth = None, 0
+        for i, part in enumerate(parts):
+            node = node.get(part)
+            if node is None:
+                break
+            if _MODULE in node:
+                module, depth = node[_MODULE], i + 1
+        if module is None:
+            return None
+
+        rest = parts[depth:]
+        for area, area_parts in self._areas:
+            if rest[:len(area_parts)] == area_parts:
+                return Location(module[0], module[1], area, os.sep.join(rest[len(area_parts):]))
+        return Location(module[0], module[1], None, os.sep.join(rest))
+
+
+class WorkspaceIndex(object):
+    def __init__(self, workspace_directory):
+        self.workspace_directory = os.path.abspath(workspace_directory)
+        # Updated in place, so references handed out stay current
+        self.portlets = {}
+        # directory -> [mtime, subdirectories, has pom.xml]
+        self._directories = {}
+        # module root -> [mtime, size, portlet name]
+        self._poms = {}
+        self._lock = RLock()
+        # Built on first use after the modules changed
+        self._path_index = None
+        # Bumped whenever the modules or the scanned tree changed
+        self.version = 0
+
+    def is_scanned_path(self, path):
+        '''
+        Whether a path is part of the tree scanned for pom.xml files
+        '''
+        rel_path = os.path.relpath(os.path.abspath(path), self.workspace_directory)
+        if rel_path.startswith(os.pardir):
+            return False
+        return not any(part in IGNORED_DIRECTORIES for part in rel_path.split(os.sep))
+
+    def areas(self):
+        '''
+        The areas of every module, whether they exist or not
+        '''
+        with self._lock:
+            return [os.path.join(module_root, area) for module_root in self.portlets for area in AREAS]
+
+    def watch_roots(self):
+        '''
+        The directories worth watching, mapped to whether their whole tree
+        is: the directories of the scanned tree, for modules and pom.xml
+        files appearing, and the areas of every module. A missing area is
+        watched through its deepest existing parent, until it is created.
+        '''
+        with self._lock:
+            roots = dict((directory, False) for directory in self._directories)
+            module_roots = list(self.portlets)
+        for module_root in module_roots:
+            for area in AREAS:
+                path = os.path.join(module_root, area)
+                if os.path.isdir(path):
+                    roots[path] = True
+                    continue
+                parent = os.path.dirname(path)
+                while parent != module_root and not os.path.isdir(parent):
+                    parent = os.path.dirname(parent)
+                roots.setdefault(parent, False)
+        return roots
+
+    def dump_state(self):
+        with self._lock:
+            return {
+                'directories': dict(self._directories),
+                'poms': dict(self._poms),
+            }
+
+    def load(self, state=None):
+        '''
+        Scan the whole workspace, reusing the entries of a dumped state
+        whose stat did not change
+        '''
+        state = state or {}
+        portlets = {}
+        with self._lock:
+            self._directories = {}
+            self._poms = {}
+            self._walk(self.workspace_directory,
+                       state.get('directories', {}),
+                       state.get('poms', {}),
+                       portlets)
+            self.portlets.clear()
+            self.portlets.update(portlets)
+            self._changed()
+        return portlets
+
+    def scan(self, directory=None):
+        '''
+        (Re)scan a directory of the workspace, replacing what the index
+        knew about that subtree
+        '''
+        directory = os.path.abspath(directory or self.workspace_directory)
+        portlets = {}
+        with self._lock:
+            cached_directories = _pop_tree(self._directories, directory)
+            cached_poms = _pop_tree(self._poms, directory)
+            self._walk(directory, cached_directories, cached_poms, portlets)
+            self._remove_tree(directory, keep=portlets)
+            self.portlets.update(portlets)
+            self._changed()
+        return portlets
+
+    def update_module(self, module_root):
+        '''
+        Re-read a single module after its pom.xml was created, changed or
+        deleted
+        '''
+        module_root = os.path.abspath(module_root)
+        portlets = {}
+        with self._lock:
+            self._read_pom(module_root, None, portlets)
+            portlet_name = portlets.get(module_root)
+            if portlet_name:
+                if self.portlets.get(module_root) != portlet_name:
+                    LOG.info('Found portlet {0} in {1}'.format(portlet_name, module_root))
+                self.portlets[module_root] = portlet_name
+            elif (module_root in self.portlets and
+                    not os.path.isfile(os.path.join(module_root, 'pom.xml'))):
+                self._poms.pop(module_root, None)
+                LOG.info('Removed portlet {0} in {1}'.format(self.portlets.pop(module_root), module_root))
+            self._changed()
+
+    def remove_tree(self, directory):
+        '''
+        Forget all modules at or below a deleted directory
+        '''
+        directory = os.path.abspath(directory)
+        with self._lock:
+            _pop_tree(self._directories, directory)
+            _pop_tree(self._poms, directory)
+            self._remove_tree(directory)
+
+    def _remove_tree(self, directory, keep=()):
+        for module_root in list(self.portlets.keys()):
+            if _in_tree(module_root, directory) and module_root not in keep:
+                LOG.info('Removed portlet {0} in {1}'.format(self.portlets.pop(module_root), module_root))
+        self._changed()
+
+    def _changed(self):
+        self._path_index = None
+        self.version += 1
+
+    def _walk(self, directory, cached_directories, cached_poms, portlets):
+        try:
+            st = os.stat(directory)
+        except OSError:
+            return
+
+        cached = cached_directories.get(directory)
+        if cached and cached[0] == st.st_mtime:
+            subdirectories, has_pom = cached[1], cached[2]
+        else:
+            subdirectories, has_pom = [], False
+            for file_name in os.listdir(directory):
+                path = os.path.join(directory, file_name)
+                if os.path.isdir(path):
+                    if not filter_filename(file_name, IGNORED_DIRECTORIES):
+                        subdirectories.append(file_name)
+                elif file_name == 'pom.xml':
+                    has_pom = True
+        self._directories[directory] = [st.st_mtime, subdirectories, has_pom]
+
+        # Deployed portlet name is derived from the war name
+        if has_pom:
+            self._read_pom(directory, cached_poms.get(directory), portlets)
+
+        for file_name in subdirectories:
+            self._walk(os.path.join(directory, file_name), cached_directories, cached_poms, portlets)
+
+    def _read_pom(self, module_root, cached, portlets):
+        pom_path = os.path.join(module_root, 'pom.xml')
+        try:
+            st = os.stat(pom_path)
+        except OSError:
+            return
+
+        if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            portlet_name = cached[2]
+        else:
+            try:
+                portlet_name = get_portlet_name(pom_path)
+            except Exception:
+                # Most likely a pom.xml that is still being written
+                LOG.warn('Could not parse {0}'.format(pom_path))
+                return
+        self._poms[module_root] = [st.st_mtime, st.st_size, portlet_name]
+        portlets[module_root] = portlet_name
+
+    def classify(self, path):
+        '''
+        The Location of a path, None when it is not in a module
+        '''
+        path_index = self._path_index
+        if path_index is None:
+            with self._lock:
+                path_index = self._path_index = PathIndex(self.portlets)
+        return path_index.classify(path)
+
+    def module_for(self, path):
+        '''
+        Find the innermost module root containing a path
+        '''
+        location = self.classify(path)
+        return location.module_root if location else None
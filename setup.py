@@ -15,10 +15,11 @@ config = {
         'watchdog',
         'pyjavaproperties',
         'pyScss',
-        'tornado>=2.2.0',
+        'tornado>=4.0,<6',
     ],
     'packages': ['hotterdeploy'],
-	'data_files': [('hotterdeploy', ['hotterdeploy/livereload.js','hotterdeploy/index.html'])],
+    'package_data': {'hotterdeploy': ['livereload.js', 'livereload-plugin.js', 'index.html']},
+	'data_files': [('hotterdeploy', ['hotterdeploy/livereload.js','hotterdeploy/livereload-plugin.js','hotterdeploy/index.html'])],
     'scripts': [],
     'name': 'hotterdeploy',
     'entry_points': {